@@ -1,17 +1,24 @@
 #!/usr/bin/env python3
 import argparse
+import copy
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import importlib.util
+import json
 import os
 from pathlib import Path
 import sys
 import shutil
 import subprocess as sp
 import threading
-import xml.etree.cElementTree as ET
+import time
+import traceback
 
 from ffmpeg_normalize import FFmpegNormalize
 from subtitle_filter import Subtitles
+from utils import cache, chunks, costmodel, journal, ocr, pgs, probecache, progress
+from utils import resources, sceneindex, transport
 from utils.info import Info, SubtitleTrackInfo, AudioTrackInfo, VideoTrackInfo
+from utils.stages import StageGraph, popen, terminateProcesses
 from utils.videoinfo import videoInfo
 from vapoursynth import core, VideoNode
 
@@ -27,14 +34,50 @@ except:
 
 # Globals
 INFOFILE = "info.json"
+LOGFILE = "batchconvert.log"
+# Journal of the finished chunks of a chunked or resumable encode.
 RESUME = "resume-file"
-
-# BDSup2Sub Settings #
-# Use java version
-# BDSUP2SUB = ['/usr/bin/java', '-jar',
-#              '~/.local/share/bdsup2sub/BDSup2Sub.jar']
-# Use C++ version
-BDSUP2SUB = ["bdsup2sub++"]
+# Frames per segment of a resumable encode that isn't chunked,
+# that's about 3.5 minutes at 23.976fps.
+RESUME_SEGMENT_FRAMES = 5000
+# Number of audio tracks converted at the same time.
+AUDIO_JOBS = 4
+# Number of subtitle tracks worked on at the same time, each in its own
+# directory in 'SUBTITLES_DIR'.
+SUBTITLE_JOBS = 4
+SUBTITLES_DIR = "subtitles"
+# Number of sup2srt processes a track is OCRed with (see 'utils/ocr.py').
+OCR_JOBS = 4
+PRINT_LOCK = threading.Lock()
+# Lossless render of the vapoursynth output (see 'getLosslessCache()').
+FILTERED_CACHE = "filtered-{}.mkv"
+# Smallest vapoursynth frame cache (MB) a job gets when the machine is shared.
+MIN_CACHE_SIZE = 1024
+# The core is shared by every title a process converts, so each title's
+# settings start from these instead of what the previous title left.
+CORE_DEFAULTS = {"threads": core.num_threads, "cacheSize": core.max_cache_size}
+LOUDNESS_LOCK = threading.Lock()
+LOUDNESS_KEY_LOCKS: dict[str, threading.Lock] = {}
+# Pre-filtered audio of a normalized track made by 'fanOutAudio()', by source
+# track id, track index, and hash of the pre-filter chain and its input.
+PRENORM_FILE = "{}-{}-{}.prenorm.flac"
+# Audio the 'extract' stage demuxes for 'convertAudio()', by ffprobe codec name.
+# Tracks in other codecs are read from the source.
+DEMUX_FILE = "{}.demux.{}"
+DEMUX_EXTENSIONS = {
+    "ac3": "ac3",
+    "eac3": "eac3",
+    "dts": "dts",
+    "truehd": "thd",
+    "flac": "flac",
+    "aac": "aac",
+    "mp3": "mp3",
+    "pcm_s16le": "wav",
+    "pcm_s24le": "wav",
+    "pcm_s32le": "wav",
+    "pcm_s16be": "wav",
+    "pcm_s24be": "wav",
+}
 
 
 def main():
@@ -52,18 +95,55 @@ def main():
                 if x.joinpath(INFOFILE).exists():
                     folders.append(x)
 
-    if len(sys.argv) == 1:
-        currentDir = Path.cwd()
-        for folder in folders:
-            print("Entering directory:", folder)
-            os.chdir(folder)
-            print(folders.index(folder), "out of", len(folders), "done.\n")
-            convertMKV(INFOFILE)
-            os.chdir(currentDir)
-
-    print("Cleaning python cache files.")
-    cleanPythonCache(".")
-
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="Number of folders to convert at the same time.",
+    )
+    parser.add_argument(
+        "--audio-jobs",
+        dest="audioJobs",
+        type=int,
+        default=AUDIO_JOBS,
+        help="Number of audio tracks to convert at the same time.",
+    )
+    parser.add_argument(
+        "--subtitle-jobs",
+        dest="subtitleJobs",
+        type=int,
+        default=SUBTITLE_JOBS,
+        help="Number of subtitle tracks to convert at the same time.",
+    )
+    parser.add_argument(
+        "--ocr-jobs",
+        dest="ocrJobs",
+        type=int,
+        default=OCR_JOBS,
+        help="Number of sup2srt processes to OCR a subtitle track with.",
+    )
+    parser.add_argument(
+        "--audio-fanout",
+        dest="audioFanout",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="Decode a source audio track once for all tracks made from it.",
+    )
+    parser.add_argument(
+        "--raw-frames",
+        dest="rawFrames",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="Send frames to x265 without Y4M headers.",
+    )
+    parser.add_argument(
+        "--progress-json",
+        dest="progressFile",
+        default="",
+        help="Append progress events of every tool to this file as json lines.",
+    )
     parser.add_argument(
         "--clean",
         dest="clean",
@@ -190,6 +270,35 @@ def main():
     )
     args = parser.parse_args()
 
+    failed = False
+    if (
+        not args.clean
+        and not args.cleanSources
+        and "syncBase" not in args
+        and "sourceFile" not in args
+    ):
+        convertOpts = {
+            "audioJobs": args.audioJobs,
+            "audioFanout": args.audioFanout,
+            "subtitleJobs": args.subtitleJobs,
+            "ocrJobs": args.ocrJobs,
+            # Titles at the same time, there can't be more than there are titles.
+            "hostJobs": max(1, min(args.jobs, len(folders))),
+            "rawFrames": args.rawFrames,
+        }
+        # Starting the longest titles first keeps jobs from idling at the end.
+        folders = costmodel.schedule(folders, INFOFILE, convertOpts["hostJobs"])
+        if not convertFolders(
+            folders, INFOFILE, args.jobs, args.progressFile, **convertOpts
+        ):
+            failed = True
+
+    print("Cleaning python cache files.")
+    cleanPythonCache(".")
+
+    if failed:
+        exit(1)
+
     if args.clean:
         cleanFiles(folders, INFOFILE)
     if args.cleanSources:
@@ -241,7 +350,10 @@ def cleanSourceFiles(folders: list, infoFile: str):
 
 
 def cleanFiles(folders: list, infoFile: str):
-    exclude = [Path(__file__).name, infoFile]
+    # The journal remembers that the output is done, even without the temp files.
+    exclude = [Path(__file__).name, infoFile, journal.JOURNAL_FILE]
+    # What the last conversion cost, to compare with the next one.
+    exclude.append(resources.RESOURCES_FILE)
     for folder in folders:
         info = Info(str(folder.joinpath(infoFile)))
         exclude.append(info.sourceMKV)
@@ -262,29 +374,186 @@ def cleanFiles(folders: list, infoFile: str):
         exclude.remove(info.sourceMKV)
 
 
-def convertMKV(infoFile):
+def convertFolders(
+    folders: list[Path],
+    infoFile: str,
+    jobs: int = 1,
+    progressFile: str = "",
+    **convertOpts,
+) -> bool:
+    if jobs <= 1:
+        failed = []
+        for folder in folders:
+            print("Entering directory:", folder)
+            print(folders.index(folder), "out of", len(folders), "done.\n")
+            if convertFolder(folder, infoFile, "", progressFile, **convertOpts) != 0:
+                failed.append(folder)
+        for folder in failed:
+            print("Failed:", folder)
+        return len(failed) == 0
+
+    # Each folder runs in its own process, and everything it prints
+    # (including the output of x265, ffmpeg, etc.) goes to its own log.
+    print("Converting {} folders, {} at a time.".format(len(folders), jobs))
+    # The jobs report their progress to one file, which is shown here as one view.
+    tempProgressFile = None
+    if not progressFile:
+        tempProgressFile = cache.cacheDir("progress").joinpath(
+            "{}.jsonl".format(os.getpid())
+        )
+        progressFile = str(tempProgressFile)
+    stopView = threading.Event()
+    viewThread = threading.Thread(
+        target=progress.watchFile, args=(progressFile, stopView), daemon=True
+    )
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(
+                convertFolder, folder, infoFile, LOGFILE, progressFile, **convertOpts
+            ): folder
+            for folder in folders
+        }
+        # The pool forks its processes in 'submit()', the view only starts
+        # after that, so no process gets a copy of a lock it was holding.
+        viewThread.start()
+        for future in as_completed(futures):
+            folder = futures[future]
+            try:
+                results[folder] = future.result()
+            except Exception as e:
+                print("Job for '{}' crashed: {}".format(folder, e))
+                results[folder] = 1
+            print(
+                "[{}/{}] {}: exit status {} (log: {})".format(
+                    len(results),
+                    len(folders),
+                    folder.name,
+                    results[folder],
+                    folder.joinpath(LOGFILE),
+                )
+            )
+
+    stopView.set()
+    viewThread.join()
+    if tempProgressFile:
+        tempProgressFile.unlink(missing_ok=True)
+
+    failed = [folder for folder in folders if results[folder] != 0]
+    for folder in failed:
+        print("Failed:", folder)
+    return len(failed) == 0
+
+
+def convertFolder(
+    folder: Path,
+    infoFile: str,
+    logFile: str = "",
+    progressFile: str = "",
+    **convertOpts,
+) -> int:
+    progress.configure(folder.name, progressFile)
+    status = 0
+    logFd = None
+    savedFds = []
+    if logFile:
+        # Redirect at the file descriptor level so child processes inherit the log.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        logFd = os.open(
+            folder.joinpath(logFile), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644
+        )
+        savedFds = [os.dup(1), os.dup(2)]
+        os.dup2(logFd, 1)
+        os.dup2(logFd, 2)
+
+    try:
+        convertMKV(str(folder.joinpath(infoFile)), **convertOpts)
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            status = e.code
+        elif e.code:
+            print(e.code)
+            status = 1
+    except KeyboardInterrupt:
+        status = 130
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        if logFd is not None:
+            print("Exit status:", status)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(savedFds[0], 1)
+            os.dup2(savedFds[1], 2)
+            for fd in savedFds + [logFd]:
+                os.close(fd)
+
+    return status
+
+
+def convertMKV(
+    infoFile,
+    audioJobs: int = AUDIO_JOBS,
+    audioFanout: bool = False,
+    subtitleJobs: int = SUBTITLE_JOBS,
+    ocrJobs: int = OCR_JOBS,
+    hostJobs: int = 1,
+    rawFrames: bool = False,
+):
     info = Info(jsonFile=infoFile)
-    outputFilePath = Path(info.outputFile).resolve()
+    outputFilePath = info.getPath(info.outputFile).resolve()
     dstPath = outputFilePath.parent.with_name(outputFilePath.name)
 
-    if not Path(info.sourceMKV).exists():
+    if not info.getPath(info.sourceMKV).exists():
         print("'{}' not found! skipping".format(info.sourceMKV))
         return
 
-    if dstPath.exists():
+    # The finished file is outside of the folder, so it's tracked by its full path.
+    stageJournal = journal.getJournal(info.folder)
+    mergeParams = dict(info)
+    mergeParams["video"] = getOutputSettings(info.videoInfo)
+    if stageJournal.isDone("merge", [info.sourceMKV], mergeParams, [dstPath]):
+        print(dstPath, "already exists! skipping...")
+        return
+    if dstPath.exists() and not stageJournal.hasEntry("merge"):
+        # Converted before there was a journal.
         print(dstPath, "already exists! skipping...")
         return
 
-    extractTracks(info)
-    print()
-    convertSubtitles(info)
-    print()
-    convertAudio(info)
-    print()
-    encodeVideo(info)
-    print()
-    mergeMKV(info)
+    # Only the stages that need each other's files wait on each other,
+    # everything else (like audio and the video encode) runs at the same time.
+    # The video stage waits for 'forcedSubs', because forced subtitles get
+    # hardcoded into the video.
+    stages = StageGraph()
+    stages.add("extract", lambda: extractTracks(info))
+    stages.add("forcedSubs", lambda: prepSubtitles(info, subtitleJobs), ["extract"])
+    stages.add(
+        "subtitles",
+        lambda: convertSubtitles(info, subtitleJobs, ocrJobs),
+        ["forcedSubs"],
+    )
+    stages.add(
+        "audio", lambda: convertAudio(info, audioJobs, audioFanout), ["extract"]
+    )
+    stages.add(
+        "video", lambda: encodeVideo(info, hostJobs, rawFrames), ["forcedSubs"]
+    )
+    stages.add(
+        "merge",
+        lambda: mergeMKV(info),
+        ["extract", "forcedSubs", "subtitles", "audio", "video"],
+    )
+    stageJournal.start("merge")
+    resources.reset()
+    try:
+        stages.run()
+    finally:
+        resources.writeSummary(info.getPath(resources.RESOURCES_FILE))
     outputFilePath.replace(dstPath)
+    stageJournal.finish("merge", [info.sourceMKV], mergeParams, [dstPath])
     print("Done")
 
 
@@ -294,6 +563,7 @@ def mergeMKV(info: Info):
 
     cmd = [
         "mkvmerge",
+        "--gui-mode",
         "--output",
         output,
         "--title",
@@ -338,50 +608,96 @@ def mergeMKV(info: Info):
             supFile,
         ]
 
-    if Path("chapters.xml").exists():
+    if info.getPath("chapters.xml").exists():
         cmd += ["--chapters", "chapters.xml"]
 
     print(" ".join(cmd))
 
-    p = sp.Popen(cmd)
-    p.communicate()
+    p = popen(cmd, stdout=sp.PIPE, cwd=info.folder)
+    progress.run(p, p.stdout, "merge", "mkvmerge", progress.parseMkvToolNix)
+    # 1 is only a warning.
+    if p.returncode not in [0, 1]:
+        print("mkvmerge failed.")
+        exit(1)
 
 
-def encodeVideo(info: Info):
-    inputInfo = videoInfo(info.sourceMKV)
-    tempOutFile = Path("temp-" + info.videoInfo.output)
-    outFile = Path(info.videoInfo.output)
+def encodeVideo(info: Info, hostJobs: int = 1, rawFrames: bool = False):
+    forcedFile = ""
+    for sub in info.subInfo:
+        if sub.getForcedFile():
+            if sub.hasForcedFile(info.folder):
+                forcedFile = str(info.getPath(sub.getForcedFile()))
+                break
 
-    if outFile.exists():
-        print(outFile, "already exists! skipping...")
+    stageJournal = journal.getJournal(info.folder)
+    params = {
+        "video": getOutputSettings(info.videoInfo),
+        "filter": getFilterKey(info, forcedFile),
+    }
+    outputs = [info.videoInfo.output]
+    if stageJournal.isDone("video", [info.sourceMKV], params, outputs):
+        print(info.getPath(info.videoInfo.output), "already exists! skipping...")
         return 0
 
+    stageJournal.start("video")
+    # A resumed encode only did part of the work, so it says nothing about speed.
+    resumed = info.getPath("chunks").joinpath(RESUME).exists()
+    encodeTime = writeVideo(info, forcedFile, hostJobs, rawFrames)
+    stageJournal.finish("video", [info.sourceMKV], params, outputs)
+    if not resumed and info.videoInfo.convert:
+        costmodel.recordEncode(info, encodeTime, hostJobs)
+
+
+def writeVideo(
+    info: Info, forcedFile: str, hostJobs: int = 1, rawFrames: bool = False
+) -> float:
+    # Returns the seconds x265 ran for, 0 when the video isn't encoded.
+    sourceFile = str(info.getPath(info.sourceMKV))
+    inputInfo = videoInfo(sourceFile)
+    tempOutFile = info.getPath("temp-" + info.videoInfo.output)
+    outFile = info.getPath(info.videoInfo.output)
+
     if not info.videoInfo.convert:
         if inputInfo.DolbyVision:
             print("Dolby Vision detected!!")
             print("Extracting video stream and converting it to DV profile 8.1")
-            inputInfo.extractDoviHEVC(str(tempOutFile))
+            if inputInfo.extractDoviHEVC(str(tempOutFile)) != 0:
+                print("Extracting the Dolby Vision video stream failed.")
+                exit(1)
             tempOutFile.replace(outFile)
             return 0
 
         # Assume video in on track 0.
-        mkvOutTrack = "0:" + str(tempOutFile)
-        cmd = ["mkvextract", info.sourceMKV, "tracks", mkvOutTrack]
+        mkvOutTrack = "0:" + tempOutFile.name
+        cmd = ["mkvextract", "--gui-mode", info.sourceMKV, "tracks", mkvOutTrack]
 
         # Print extract command
         print(" ".join(cmd))
 
-        extractProc = sp.Popen(cmd)
-        extractProc.communicate()
+        extractProc = popen(cmd, stdout=sp.PIPE, cwd=info.folder)
+        progress.run(
+            extractProc,
+            extractProc.stdout,
+            "video",
+            "mkvextract",
+            progress.parseMkvToolNix,
+        )
+        # 1 is only a warning.
+        if extractProc.returncode not in [0, 1]:
+            print("mkvextract failed.")
+            exit(1)
         tempOutFile.replace(outFile)
         return 0
 
+    configureCore(info, hostJobs)
+    prefetch = int(info.videoInfo.vapoursynthCore.get("prefetch", 0))
+
     video = None
     # If a vapoursynth script is specified load it in as a module.
     if info.videoInfo.vapoursynthScript:
-        vapoursynthScriptPath = info.videoInfo.vapoursynthScript
+        vapoursynthScriptPath = info.getPath(info.videoInfo.vapoursynthScript)
 
-        if not Path(vapoursynthScriptPath).exists():
+        if not vapoursynthScriptPath.exists():
             print("'{}' doesn't exist!".format(vapoursynthScriptPath))
             exit(1)
 
@@ -402,7 +718,7 @@ def encodeVideo(info: Info):
             vsScriptVars = None
             if info.videoInfo.vapoursynthVars:
                 vsScriptVars = info.videoInfo.vapoursynthVars
-            video = vapoursynthScript.vapoursynthFilter(info.sourceMKV, vsScriptVars)
+            video = vapoursynthScript.vapoursynthFilter(sourceFile, vsScriptVars)
         else:
             print(
                 "'vapoursynthFilter()' Doesn't exist in {}".format(
@@ -415,28 +731,39 @@ def encodeVideo(info: Info):
             exit(1)
         print("Using 'vapoursynthFilter()' from '{}'".format(vapoursynthScriptPath))
     else:
-        video = core.ffms2.Source(info.sourceMKV)
+        video = core.ffms2.Source(sourceFile)
 
     encodeProcess = None
 
     # Encode thread Function
-    def encodeThread(video, cmd):
+    # The encode threads count towards the stage that started them.
+    resourceStage = resources.currentStage()
+
+    def encodeThread(video, cmd, stage):
         nonlocal encodeProcess
-        encodeProcess = sp.Popen(cmd, stdin=sp.PIPE)
-        video.output(encodeProcess.stdin, y4m=True)
-        encodeProcess.communicate()
+        resources.setStage(resourceStage)
+        encodeProcess = popen(
+            cmd, stdin=sp.PIPE, stderr=sp.PIPE, bufsize=0, cwd=info.folder
+        )
+        outputToEncoder(video, encodeProcess, prefetch, rawArgs is not None, stage)
 
-    for sub in info.subInfo:
-        if sub.getForcedFile():
-            if sub.hasForcedFile():
-                print("Hardcoding Subtitles:", sub.getForcedFile())
-                video = core.sub.ImageFile(video, sub.getForcedFile())
-                break
+    if forcedFile:
+        print("Hardcoding Subtitles:", Path(forcedFile).name)
+        video = core.sub.ImageFile(video, forcedFile)
+
+    if info.videoInfo.losslessCache:
+        video = getLosslessCache(info, video, forcedFile, prefetch)
+
+    rawArgs = None
+    if rawFrames:
+        rawArgs = transport.x265RawArgs(video)
+        if rawArgs is None:
+            print("x265 can't read {} as raw frames, using Y4M.".format(video.format))
 
     if inputInfo.HDR10Plus:
         print("HDR10+ Detected!!")
         print("Extracting it with '{}'.".format(inputInfo.HDR10PlusTool))
-        if inputInfo.extractHDR10PlusMetadata() != 0:
+        if not shutil.which(inputInfo.HDR10PlusTool):
             print("'{}' not in PATH".format(inputInfo.HDR10PlusTool))
             exit(1)
     if inputInfo.DolbyVision:
@@ -446,19 +773,176 @@ def encodeVideo(info: Info):
                 inputInfo.DoviTool
             )
         )
-        if inputInfo.extractDoviRPU() != 0:
+        if not shutil.which(inputInfo.DoviTool):
             print("'{}' not in PATH".format(inputInfo.DoviTool))
             exit(1)
+    # Both tools read the same copy of the video stream.
+    if inputInfo.extractMetadata(inputInfo.HDR10Plus, inputInfo.DolbyVision) != 0:
+        print("Extracting HDR metadata failed.")
+        exit(1)
+
+    if info.videoInfo.chunked or info.videoInfo.resume:
+        filterKey = getFilterKey(info, forcedFile)
+        encodeTime = encodeChunks(
+            info, inputInfo, video, tempOutFile, filterKey, hostJobs, rawArgs
+        )
+        tempOutFile.replace(outFile)
+        return encodeTime
+
+    cmd = getX265Cmd(
+        info,
+        inputInfo,
+        tempOutFile.name,
+        video.num_frames,
+        inputInfo.HDR10PlusMetadataFile,
+        inputInfo.DVMetadataFile,
+        rawArgs,
+    )
+    if hostJobs > 1 and "--pools" not in info.videoInfo.x265Opts:
+        # Leave the other jobs on this machine their share of it.
+        cmd += ["--pools", str(max(1, (os.cpu_count() or 1) // hostJobs))]
+    passCmds = getPassCmds(cmd, info.videoInfo.twoPass)
+
+    # CTRL-C is handled by the stage graph, which terminates x265 (see
+    # 'stages.terminateProcesses()').
+    started = time.monotonic()
+    for i, passCmd in enumerate(passCmds):
+        print(" ".join(passCmd))
+        stage = "video" if len(passCmds) == 1 else "video:pass{}".format(i + 1)
+        t = threading.Thread(target=encodeThread, args=(video, passCmd, stage))
+        t.start()
+        t.join()
+        checkEncodeProcess(encodeProcess)
+    encodeTime = time.monotonic() - started
+
+    tempOutFile.replace(outFile)
+    return encodeTime
+
+
+def configureCore(info: Info, hostJobs: int = 1):
+    # Has to happen before the script creates any filters. Every job on this
+    # machine has its own vapoursynth core, so with several jobs each one
+    # only gets its share of the threads and the frame cache.
+    settings = info.videoInfo.vapoursynthCore
+    threads = CORE_DEFAULTS["threads"]
+    cacheSize = CORE_DEFAULTS["cacheSize"]
+    if hostJobs > 1:
+        threads = max(1, (os.cpu_count() or 1) // hostJobs)
+        cacheSize = max(MIN_CACHE_SIZE, cacheSize // hostJobs)
+    core.num_threads = int(settings.get("threads", threads))
+    core.max_cache_size = int(settings.get("cacheSize", cacheSize))
+    print(
+        "VapourSynth: {} threads, {}MB frame cache".format(
+            core.num_threads, core.max_cache_size
+        )
+    )
+
 
+def getOutputSettings(videoInfo: VideoTrackInfo) -> dict:
+    # The settings of the vapoursynth core don't change the encoded video,
+    # changing them shouldn't start the encode over.
+    settings = dict(videoInfo)
+    if "vapoursynth" in settings:
+        settings["vapoursynth"] = {
+            key: value
+            for key, value in settings["vapoursynth"].items()
+            if key in ["script", "variables"]
+        }
+    return settings
+
+
+def getFilterKey(info: Info, forcedFile: str) -> str:
+    # Changes with anything that changes the frames going into x265.
+    keyData = {
+        "source": cache.fileFingerprint(info.getPath(info.sourceMKV)),
+        "variables": info.videoInfo.vapoursynthVars,
+        "script": "",
+        "forcedSubs": "",
+    }
+    script = info.getPath(info.videoInfo.vapoursynthScript)
+    if info.videoInfo.vapoursynthScript and script.exists():
+        keyData["script"] = cache.hashKey(script.read_text())
+    if forcedFile:
+        keyData["forcedSubs"] = cache.fileFingerprint(forcedFile)
+    return cache.hashKey(keyData)
+
+
+def getLosslessCache(
+    info: Info, video: VideoNode, forcedFile: str, prefetch: int = 0
+) -> VideoNode:
+    # Filters like 'haf.GSMC' can be slower than x265 itself, so render the
+    # filtered video once to a lossless file, and have every pass (and every
+    # later encode with different x265Opts) read that instead.
+    filterKey = getFilterKey(info, forcedFile)
+    cacheFile = info.getPath(FILTERED_CACHE.format(filterKey[:16]))
+
+    for oldFile in info.folder.glob(FILTERED_CACHE.format("*")):
+        if oldFile.name != cacheFile.name:
+            print("Deleting outdated filtered video:", oldFile.name)
+            oldFile.unlink()
+    for oldIndex in info.folder.glob(FILTERED_CACHE.format("*") + ".ffindex"):
+        if oldIndex.name != cacheFile.name + ".ffindex":
+            oldIndex.unlink()
+
+    if cacheFile.exists():
+        print("Using filtered video from '{}'".format(cacheFile.name))
+        return core.ffms2.Source(str(cacheFile))
+
+    tempFile = cacheFile.with_suffix(".temp.mkv")
     cmd = [
-        "x265",
-        "--y4m",
+        "ffmpeg",
+        "-y",
+        "-loglevel",
+        "error",
+        "-nostats",
+        "-progress",
+        "pipe:1",
+        "-f",
+        "yuv4mpegpipe",
+        "-i",
+        "-",
+        "-c:v",
+        "ffv1",
+        "-level",
+        "3",
+        "-g",
+        "1",
+        "-slices",
+        "24",
+        "-slicecrc",
+        "1",
+        tempFile.name,
+    ]
+    print("Rendering filtered video to '{}'".format(cacheFile.name))
+    print(" ".join(cmd))
+    renderProcess = popen(
+        cmd, stdin=sp.PIPE, stdout=sp.PIPE, bufsize=0, cwd=info.folder
+    )
+    outputToEncoder(video, renderProcess, prefetch, False, "losslessCache", "ffmpeg")
+    checkEncodeProcess(renderProcess, "ffmpeg")
+    tempFile.replace(cacheFile)
+
+    return core.ffms2.Source(str(cacheFile))
+
+
+def getX265Cmd(
+    info: Info,
+    inputInfo: videoInfo,
+    output: str,
+    frames: int,
+    hdr10PlusFile: str | None = None,
+    rpuFile: str | None = None,
+    rawArgs: list[str] | None = None,
+) -> list[str]:
+    # Without 'rawArgs' (see 'transport.x265RawArgs()') x265 gets Y4M.
+    cmd = ["x265"] + (rawArgs or ["--y4m"])
+    cmd += [
         "--input",
         "-",
         "--output",
-        str(tempOutFile),
+        output,
         "--frames",
-        str(video.num_frames),
+        str(frames),
     ]
 
     if inputInfo.ColorRange:
@@ -481,7 +965,7 @@ def encodeVideo(info: Info):
     if inputInfo.DolbyVision:
         cmd += [
             "--dolby-vision-rpu",
-            inputInfo.DVMetadataFile,
+            str(rpuFile),
             "--dolby-vision-profile",
             "8.1",
             "--vbv-bufsize",
@@ -491,94 +975,310 @@ def encodeVideo(info: Info):
         ]
 
     if inputInfo.HDR10Plus:
-        cmd += ["--dhdr10-info=" + str(inputInfo.HDR10PlusMetadataFile)]
+        cmd += ["--dhdr10-info=" + str(hdr10PlusFile)]
 
     cmd += info.videoInfo.x265Opts
-    cmd2 = cmd.copy()
+    return cmd
 
-    if info.videoInfo.twoPass:
-        cmd = cmd[:1] + ["--pass", "1", "--no-slow-firstpass"] + cmd[1:]
-        cmd2 = cmd2[:1] + ["--pass", "2"] + cmd2[1:]
 
-    print(" ".join(cmd))
+def getPassCmds(cmd: list[str], twoPass: bool, statsFile: str = "") -> list[list[str]]:
+    if statsFile:
+        cmd = cmd[:1] + ["--stats", statsFile] + cmd[1:]
+    if not twoPass:
+        return [cmd]
+
+    return [
+        cmd[:1] + ["--pass", "1", "--no-slow-firstpass"] + cmd[1:],
+        cmd[:1] + ["--pass", "2"] + cmd[1:],
+    ]
+
+
+def outputToEncoder(
+    video: VideoNode,
+    encodeProcess: sp.Popen,
+    prefetch: int = 0,
+    raw: bool = False,
+    stage: str = "",
+    tool: str = "x265",
+):
+    # With a 'stage', x265 has to be started with its stderr piped, and ffmpeg
+    # with its stdout piped and '-progress pipe:1'.
+    watcher = None
+    if stage and tool == "x265":
+        watcher = progress.watch(
+            encodeProcess.stderr, stage, tool, progress.parseX265
+        )
+    elif stage:
+        parse = progress.ffmpegParser(frames=video.num_frames)
+        watcher = progress.watch(encodeProcess.stdout, stage, tool, parse)
 
     try:
-        # We have to run the encode process in a separate thread, because
-        # CTRTL-C won't work normally when x265 is used via subprocess.
-        t = threading.Thread(target=encodeThread, args=(video, cmd))
-        t.start()
-        t.join()
+        # A prefetch of 0 lets vapoursynth request as many frames as it has threads.
+        transport.outputFrames(video, encodeProcess.stdin, raw, prefetch)
+    except Exception as e:
+        # x265 went away, or VapourSynth failed. Either way stop x265.
+        print("Frame output stopped:", e)
+        encodeProcess.terminate()
+    try:
+        encodeProcess.stdin.close()
+    except OSError:
+        pass
+    encodeProcess.wait()
+    if watcher:
+        watcher.join()
+        progress.finish(stage, tool, encodeProcess.returncode)
+
+
+def encodeChunks(
+    info: Info,
+    inputInfo: videoInfo,
+    video: VideoNode,
+    outFile: Path,
+    filterKey: str,
+    hostJobs: int = 1,
+    rawArgs: list[str] | None = None,
+) -> float:
+    # A resumable encode that isn't chunked is a chunked encode with one
+    # x265 process, and segments short enough to not lose much on a restart.
+    # Returns the seconds the chunks took to encode.
+    workers = 1
+    minFrames = chunks.MIN_CHUNK_FRAMES
+    targetFrames = RESUME_SEGMENT_FRAMES
+    if info.videoInfo.chunked:
+        workers = int(info.videoInfo.chunked.get("workers", os.cpu_count() or 1))
+        minFrames = int(info.videoInfo.chunked.get("minFrames", minFrames))
+        targetFrames = 0
+    chunkDir = info.getPath("chunks")
+    chunkDir.mkdir(exist_ok=True)
+    resumeFile = chunkDir.joinpath(RESUME)
+
+    # Anything that changes the output of a chunk.
+    encodeKey = cache.hashKey(
+        {
+            "filter": filterKey,
+            "frames": video.num_frames,
+            "x265Opts": info.videoInfo.x265Opts,
+            "twoPass": info.videoInfo.twoPass,
+        }
+    )
+    resumeState = readResumeFile(resumeFile)
+    if resumeState.get("key") == encodeKey:
+        plan = [(start, end) for start, end in resumeState["plan"]]
+        print(
+            "Resuming encode, {} of {} chunks are already done.".format(
+                len(resumeState["done"]), len(plan)
+            )
+        )
+    else:
+        if resumeState:
+            print("Encode settings changed, not resuming the previous encode.")
+        for oldFile in chunkDir.iterdir():
+            if oldFile.is_file():
+                oldFile.unlink()
+
+        index = sceneindex.getSceneIndex(str(info.getPath(info.sourceMKV)))
+        keyframes = chunks.scaleKeyframes(
+            index.splitPoints(), index.frameCount, video.num_frames
+        )
+        plan = chunks.planChunks(
+            video.num_frames, keyframes, workers, minFrames, targetFrames
+        )
+        resumeState = {"key": encodeKey, "plan": plan, "done": {}}
+        writeResumeFile(resumeFile, resumeState)
+    resumeStateLock = threading.Lock()
 
+    print(
+        "Encoding {} frames as {} chunks with {} x265 processes.".format(
+            video.num_frames, len(plan), workers
+        )
+    )
+
+    x265Opts = info.videoInfo.x265Opts
+    if workers > 1 or hostJobs > 1:
+        # Split the machine between the x265 processes, unless told otherwise.
+        if "--pools" not in x265Opts:
+            pools = max(1, (os.cpu_count() or 1) // (workers * hostJobs))
+            x265Opts = x265Opts + ["--pools", str(pools)]
+    chunkInfo = copy.copy(info)
+    chunkInfo.videoInfo = copy.copy(info.videoInfo)
+    chunkInfo.videoInfo.x265Opts = x265Opts
+    prefetch = int(info.videoInfo.vapoursynthCore.get("prefetch", 0))
+
+    def encodeChunk(index: int, start: int, end: int) -> Path:
+        name = "chunk-{:04d}".format(index)
+        chunkFile = chunkDir.joinpath(name + ".hevc")
+        tempChunkFile = chunkDir.joinpath(name + ".temp.hevc")
+
+        # Skip chunks that finished before the last encode was interrupted.
+        doneSize = resumeState["done"].get(str(index))
+        if doneSize is not None and chunkFile.exists():
+            if chunkFile.stat().st_size == doneSize:
+                return chunkFile
+
+        hdr10PlusFile = None
+        rpuFile = None
+        if inputInfo.HDR10Plus:
+            hdr10PlusFile = str(chunkDir.joinpath(name + "_hdrplus.json"))
+            chunks.sliceHDR10PlusJson(
+                str(inputInfo.HDR10PlusMetadataFile), hdr10PlusFile, start, end
+            )
+        if inputInfo.DolbyVision:
+            rpuFile = str(chunkDir.joinpath(name + "_dv.rpu"))
+            chunks.sliceDoviRPU(
+                str(inputInfo.DVMetadataFile),
+                rpuFile,
+                start,
+                end,
+                video.num_frames,
+                inputInfo.DoviTool,
+            )
+
+        cmd = getX265Cmd(
+            chunkInfo,
+            inputInfo,
+            tempChunkFile.name,
+            end - start,
+            hdr10PlusFile,
+            rpuFile,
+            rawArgs,
+        )
+        statsFile = ""
         if info.videoInfo.twoPass:
-            print(" ".join(cmd2))
-            t = threading.Thread(target=encodeThread, args=(video, cmd2))
-            t.start()
-            t.join()
-    except KeyboardInterrupt:
-        # Close the processes stdin, because x265 doesn't do it by itself.
-        if type(encodeProcess) == sp.Popen:
-            encodeProcess.terminate()
-        exit(0)
+            statsFile = name + ".stats"
+        passCmds = getPassCmds(cmd, info.videoInfo.twoPass, statsFile)
+        for i, passCmd in enumerate(passCmds):
+            print("Chunk {} ({}-{}): {}".format(index, start, end, " ".join(passCmd)))
+            stage = "video:" + name
+            if len(passCmds) > 1:
+                stage += ":pass{}".format(i + 1)
+            encodeProcess = popen(
+                passCmd, stdin=sp.PIPE, stderr=sp.PIPE, bufsize=0, cwd=chunkDir
+            )
+            outputToEncoder(
+                video[start:end], encodeProcess, prefetch, rawArgs is not None, stage
+            )
+            checkEncodeProcess(encodeProcess)
+
+        tempChunkFile.replace(chunkFile)
+        with resumeStateLock:
+            resumeState["done"][str(index)] = chunkFile.stat().st_size
+            writeResumeFile(resumeFile, resumeState)
+        printProgress("chunks", "chunk {} of {} done".format(index + 1, len(plan)))
+        return chunkFile
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(
+        max_workers=workers,
+        initializer=resources.setStage,
+        initargs=(resources.currentStage(),),
+    ) as executor:
+        futures = [
+            executor.submit(encodeChunk, index, start, end)
+            for index, (start, end) in enumerate(plan)
+        ]
+        try:
+            chunkFiles = [future.result() for future in futures]
+        except BaseException:
+            # Don't keep encoding the other chunks of a failed encode.
+            for future in futures:
+                future.cancel()
+            terminateProcesses()
+            raise
 
-    tempOutFile.replace(outFile)
+    encodeTime = time.monotonic() - started
+
+    print("Joining {} chunks into '{}'".format(len(chunkFiles), outFile.name))
+    chunks.concatenateChunks(chunkFiles, outFile)
+    shutil.rmtree(chunkDir, ignore_errors=True)
+    return encodeTime
+
+
+def readResumeFile(resumeFile: Path) -> dict:
+    try:
+        return json.loads(resumeFile.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def writeResumeFile(resumeFile: Path, journal: dict):
+    # Written to a temp file first, so a power cut can't leave half a journal.
+    tempFile = resumeFile.with_name(resumeFile.name + ".temp")
+    tempFile.write_text(json.dumps(journal))
+    tempFile.replace(resumeFile)
+
+
+def checkEncodeProcess(encodeProcess: sp.Popen | None, name: str = "x265"):
+    # When running next to other stages the encode can be stopped from outside
+    # (failed stage, CTRL-C), so don't mistake a killed x265 for a finished one.
+    if encodeProcess is None or encodeProcess.returncode != 0:
+        print("{} did not finish successfully.".format(name))
+        exit(1)
+
+
+def getScratchDir(folder: Path, track: SubtitleTrackInfo) -> Path:
+    # Temp files of one track, so several tracks (or titles) can be worked on
+    # at the same time without using each other's files.
+    # 'SUBTITLES_DIR' itself is made by 'runSubtitleJobs()'.
+    scratchDir = folder.joinpath(SUBTITLES_DIR, track.getOutFile())
+    scratchDir.mkdir(exist_ok=True)
+    return scratchDir
 
 
-def prepForcedSubs(track: SubtitleTrackInfo):
+def removeScratchDir(scratchDir: Path):
+    shutil.rmtree(scratchDir, ignore_errors=True)
+
+
+def runSubtitleJobs(
+    func, tracks: list[SubtitleTrackInfo], subtitleJobs: int, folder: Path
+):
+    if not tracks:
+        return
+    # Made and removed while no track uses it, the tracks only touch their
+    # own directory in it.
+    subtitlesDir = folder.joinpath(SUBTITLES_DIR)
+    subtitlesDir.mkdir(exist_ok=True)
+    with ThreadPoolExecutor(
+        max_workers=max(1, subtitleJobs),
+        initializer=resources.setStage,
+        initargs=(resources.currentStage(),),
+    ) as executor:
+        futures = [executor.submit(func, track) for track in tracks]
+        for future in futures:
+            future.result()
+    try:
+        subtitlesDir.rmdir()
+    except OSError:
+        pass
+
+
+def prepForcedSubs(track: SubtitleTrackInfo, folder: Path):
     if track.external:
         print("Not checking external subtitles for forced subs.")
         return 0
 
-    cmd = BDSUP2SUB + [
-        "--forced-only",
-        "--output",
-        track.getForcedFile(),
-        track.getOutFile(),
-    ]
-    p = sp.Popen(cmd, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
-    p.communicate()
+    # The forced captions go to their own file (to be hardcoded into the
+    # video), and the track keeps only the other ones.
+    stage = "forcedSubs:" + track.getOutFile()
+    supFile = folder.joinpath(track.getOutFile())
+    scratchDir = getScratchDir(folder, track)
+    tempForcedFile = scratchDir.joinpath(track.getForcedFile())
+    tempOutFile = scratchDir.joinpath(track.getOutFile())
     print("Checking if '" + track.getOutFile() + "' has forced subs")
-    if track.hasForcedFile():
-        os.mkdir("subtitles")
-        os.chdir("subtitles")
-        cmd = BDSUP2SUB + [
-            "--output",
-            "subtitles.xml",
-            str(Path("..", track.getOutFile())),
-        ]
-        print("Exporting to BDXML.")
-        p = sp.Popen(cmd, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
-        p.communicate()
-
-        print("Swapping forced subtitle flag.")
-        tree = ET.parse("subtitles.xml")
-        root = tree.getroot()
-        for event in root.iter("Event"):
-            if event.attrib["Forced"] in "False":
-                event.set("Forced", "True")
-            else:
-                event.set("Forced", "False")
-        tree.write("subtitles-new.xml")
-        os.chdir("..")
-        print("Exporting to", track.getOutFile())
-        cmd = BDSUP2SUB + [
-            "--forced-only",
-            "--output",
-            "subtitles-temp.sup",
-            str(Path("subtitles", "subtitles-new.xml")),
-        ]
-        p = sp.Popen(cmd, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
-        p.communicate()
-        cmd = BDSUP2SUB + [
-            "--force-all",
-            "clear",
-            "--output",
-            track.getOutFile(),
-            "subtitles-temp.sup",
-        ]
-        p = sp.Popen(cmd, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
-        p.communicate()
-        shutil.rmtree("subtitles", ignore_errors=True)
-        os.remove("subtitles-temp.sup")
+    progress.start(stage, "pgs")
+    try:
+        forced = pgs.splitForced(supFile, tempForcedFile, tempOutFile)
+    except (OSError, ValueError) as e:
+        progress.finish(stage, "pgs", 1)
+        print("Reading '{}' failed: {}".format(track.getOutFile(), e))
+        exit(1)
+    if forced:
+        print(
+            "Moving {} forced captions to '{}'.".format(forced, track.getForcedFile())
+        )
+        tempForcedFile.replace(folder.joinpath(track.getForcedFile()))
+        tempOutFile.replace(supFile)
+    progress.finish(stage, "pgs")
+    removeScratchDir(scratchDir)
 
 
 def subtitlesFilter(inFile: str):
@@ -588,7 +1288,7 @@ def subtitlesFilter(inFile: str):
     srt.save()
 
 
-def subtitlesOCR(track: SubtitleTrackInfo):
+def subtitlesOCR(track: SubtitleTrackInfo, folder: Path, ocrJobs: int = OCR_JOBS):
     if not shutil.which("sup2srt"):
         print("'sup2srt' is not found!")
         exit(1)
@@ -597,58 +1297,126 @@ def subtitlesOCR(track: SubtitleTrackInfo):
         print("'sup2srt' enabled, but no matching 'sup' track.")
         exit(1)
 
-    tempOutFile = Path("temp-" + track.getOutFile())
-    outFile = Path(track.getOutFile())
-
-    cmd = [
-        "sup2srt",
-        "-l",
-        track.language,
-        "-o",
-        str(tempOutFile),
-        track.sourceTrack.getOutFile(),
-    ]
+    # sup2srt runs in the track's scratch directory, for whatever it leaves there.
+    scratchDir = getScratchDir(folder, track)
+    tempOutFile = scratchDir.joinpath(track.getOutFile())
+    outFile = folder.joinpath(track.getOutFile())
 
     print("\nCreating SRT of track {} via sup2srt.".format(track.id))
-    print(" ".join(cmd))
-    sup2srtProcess = sp.Popen(cmd)
-    sup2srtProcess.communicate()
+    try:
+        ocr.ocr(
+            folder.joinpath(track.sourceTrack.getOutFile()),
+            tempOutFile,
+            track.language,
+            scratchDir,
+            ocrJobs,
+            "subtitles:" + track.getOutFile(),
+        )
+    except (RuntimeError, OSError, ValueError) as e:
+        print("OCR of track {} failed: {}".format(track.id, e))
+        exit(1)
 
     if track.srtFilter:
         subtitlesFilter(str(tempOutFile))
 
     tempOutFile.replace(outFile)
+    removeScratchDir(scratchDir)
+
+
+def prepSubtitles(info: Info, subtitleJobs: int = SUBTITLE_JOBS):
+    stageJournal = journal.getJournal(info.folder)
+
+    def prepTrack(track: SubtitleTrackInfo):
+        name = "forcedSubs:" + track.getOutFile()
+        if stageJournal.isDone(
+            name, [track.getOutFile()], dict(track), stageJournal.outputs(name)
+        ):
+            return
+        stageJournal.start(name)
+        info.getPath(track.getForcedFile()).unlink(missing_ok=True)
+        prepForcedSubs(track, info.folder)
+        # The forced captions might have been moved out of the extracted track.
+        stageJournal.refreshOutputs("extract:" + track.getOutFile())
+        outputs = []
+        if track.hasForcedFile(info.folder):
+            outputs.append(track.getForcedFile())
+        stageJournal.finish(name, [track.getOutFile()], dict(track), outputs)
+
+    tracks = [
+        track for track in info.subInfo if not track.sup2srt and not track.srtFilter
+    ]
+    runSubtitleJobs(prepTrack, tracks, subtitleJobs, info.folder)
 
 
-def convertSubtitles(info: Info):
-    for track in info.subInfo:
-        if not track.sup2srt and not track.srtFilter:
-            prepForcedSubs(track)
-
-    for track in info.subInfo:
+def convertSubtitles(
+    info: Info, subtitleJobs: int = SUBTITLE_JOBS, ocrJobs: int = OCR_JOBS
+):
+    stageJournal = journal.getJournal(info.folder)
+
+    def convertTrack(track: SubtitleTrackInfo):
+        if not track.sourceTrack:
+            if track.sup2srt:
+                subtitlesOCR(track, info.folder, ocrJobs)
+            return
+
+        name = "subtitles:" + track.getOutFile()
+        inputs = [track.sourceTrack.getOutFile()]
+        outputs = [track.getOutFile()]
+        if stageJournal.isDone(name, inputs, dict(track), outputs):
+            print(track.getOutFile(), "already exists! skipping...")
+            return
 
+        stageJournal.start(name)
         if track.sup2srt:
-            if Path(track.getOutFile()).exists():
-                print(track.getOutFile(), "already exists! skipping...")
-                continue
-            subtitlesOCR(track)
-        elif track.srtFilter:
-            if not track.sourceTrack:
-                continue
-            shutil.copy(track.sourceTrack.getOutFile(), track.getOutFile())
-            subtitlesFilter(track.getOutFile())
-
-
-def ffmpegRun(cmd):
+            subtitlesOCR(track, info.folder, ocrJobs)
+        else:
+            scratchDir = getScratchDir(info.folder, track)
+            tempOutFile = scratchDir.joinpath(track.getOutFile())
+            shutil.copy(info.getPath(track.sourceTrack.getOutFile()), tempOutFile)
+            subtitlesFilter(str(tempOutFile))
+            tempOutFile.replace(info.getPath(track.getOutFile()))
+            removeScratchDir(scratchDir)
+        stageJournal.finish(name, inputs, dict(track), outputs)
+
+    tracks = [track for track in info.subInfo if track.sup2srt or track.srtFilter]
+    # Every track OCRed at the same time starts its own sup2srt processes, all
+    # of them together shouldn't be more than there are CPUs.
+    ocrTracks = len([track for track in tracks if track.sup2srt])
+    if ocrTracks:
+        parallelTracks = max(1, min(subtitleJobs, ocrTracks))
+        ocrJobs = max(1, min(ocrJobs, (os.cpu_count() or 1) // parallelTracks))
+    runSubtitleJobs(convertTrack, tracks, subtitleJobs, info.folder)
+
+
+def printProgress(label: str, line: str):
+    with PRINT_LOCK:
+        print("[{}] {}".format(label, line), flush=True)
+
+
+def ffmpegRun(cmd, cwd: Path | None = None, label: str = ""):
+    # Progress comes from '-progress' on stdout, the log on stderr is only
+    # shown when ffmpeg fails.
+    cmd = cmd[:1] + ["-nostats", "-progress", "pipe:1"] + cmd[1:]
     print(" ".join(cmd))
-    p = sp.Popen(cmd, stderr=sp.STDOUT, stdout=sp.PIPE, universal_newlines=True)
-    if not p.stdout:
-        return None
-    for line in p.stdout:
-        line = line.rstrip()
-        if "size=" in line:
-            print(f"{line}\r", end="")
-    print()
+    p = popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, cwd=cwd)
+    logThread, log = progress.tail(p.stderr)
+    parse = progress.ffmpegParser(getInputDuration(cmd, cwd))
+    progress.run(p, p.stdout, label or "ffmpeg", "ffmpeg", parse)
+    logThread.join()
+    if p.returncode != 0:
+        print("\n".join(log))
+    return p.returncode
+
+
+def getInputDuration(cmd: list[str], cwd: Path | None = None) -> float:
+    # Duration of ffmpeg's first input, 0 when it isn't known.
+    if "-i" not in cmd:
+        return 0
+    inFile = Path(cwd or ".").joinpath(cmd[cmd.index("-i") + 1])
+    try:
+        return float(probecache.probe(str(inFile))["format"]["duration"])
+    except (sp.CalledProcessError, OSError, KeyError, ValueError):
+        return 0
 
 
 def getffFilter(surVol: float, lfeVol: float, centerVol: float):
@@ -666,27 +1434,13 @@ def getffFilter(surVol: float, lfeVol: float, centerVol: float):
     return "pan=stereo|{}|{}".format(ffPanFilterL, ffPanFilterR)
 
 
-def convertAudioTrack(sourceFile: str, audioTrack: AudioTrackInfo):
-    normalize: bool = False
-    encodeOpts = None
-    tempOutFile = Path("temp-" + audioTrack.getOutFile())
+def getAudioFilters(audioTrack: AudioTrackInfo) -> tuple[list, dict | None, list]:
+    # Returns the filters that go before 'normalize', the 'normalize' options,
+    # and the filters that go after it.
+    preFilter: list = []
+    normalize = None
     Filter: list = []
 
-    if "encodeOpts" in audioTrack.convert:
-        if audioTrack.convert["encodeOpts"]:
-            encodeOpts = audioTrack.convert["encodeOpts"]
-
-    ffmpeg_normalize = FFmpegNormalize(
-        audio_codec=audioTrack.convert["codec"],
-        extra_output_options=encodeOpts,
-        progress=True,
-        auto_lower_loudness_target=True,
-    )
-
-    if Path(audioTrack.getOutFile()).exists():
-        print(audioTrack.getOutFile(), "already exists! skipping...")
-        return 0
-
     if "filters" in audioTrack.convert:
         for ffFilter in audioTrack.convert["filters"]:
             if "ffmpeg" in ffFilter.keys():
@@ -703,111 +1457,494 @@ def convertAudioTrack(sourceFile: str, audioTrack: AudioTrackInfo):
                 )
 
             if "normalize" in ffFilter.keys():
-                normalize = True
-                ffmpeg_normalize.pre_filter = ",".join(Filter)
+                normalize = ffFilter["normalize"]
+                preFilter = Filter
                 Filter = []
-                if "keep" == ffFilter["normalize"]["loudness_range_target"]:
-                    ffmpeg_normalize.keep_lra_above_loudness_range_target = True
-                else:
-                    ffmpeg_normalize.loudness_range_target = ffFilter["normalize"][
-                        "loudness_range_target"
-                    ]
-                ffmpeg_normalize.target_level = ffFilter["normalize"]["target_level"]
-                if "true_peak" in ffFilter["normalize"]:
-                    ffmpeg_normalize.true_peak = ffFilter["normalize"]["true_peak"]
-
-    if normalize:
+
+    return preFilter, normalize, Filter
+
+
+def convertAudioTrack(
+    sourceFile: str,
+    audioTrack: AudioTrackInfo,
+    folder: Path,
+    label: str = "",
+    prefiltered: Path | None = None,
+):
+    encodeOpts = None
+    tempOutFile = folder.joinpath("temp-" + audioTrack.getOutFile())
+
+    if "encodeOpts" in audioTrack.convert:
+        if audioTrack.convert["encodeOpts"]:
+            encodeOpts = audioTrack.convert["encodeOpts"]
+
+    ffmpeg_normalize = FFmpegNormalize(
+        audio_codec=audioTrack.convert["codec"],
+        extra_output_options=encodeOpts,
+        # Several progress bars at once would just garble the terminal.
+        progress=not label,
+        auto_lower_loudness_target=True,
+    )
+
+    stageJournal = journal.getJournal(folder)
+    name = "audio:" + audioTrack.getOutFile()
+    outputs = [audioTrack.getOutFile()]
+    if stageJournal.isDone(name, [sourceFile], dict(audioTrack), outputs):
+        print(audioTrack.getOutFile(), "already exists! skipping...")
+        return 0
+    stageJournal.start(name)
+
+    preFilter, normalize, Filter = getAudioFilters(audioTrack)
+    if normalize is not None:
+        if "keep" == normalize["loudness_range_target"]:
+            ffmpeg_normalize.keep_lra_above_loudness_range_target = True
+        else:
+            ffmpeg_normalize.loudness_range_target = normalize["loudness_range_target"]
+        ffmpeg_normalize.target_level = normalize["target_level"]
+        if "true_peak" in normalize:
+            ffmpeg_normalize.true_peak = normalize["true_peak"]
         ffmpeg_normalize.post_filter = ",".join(Filter)
-        normTemp = Path(str(audioTrack.id) + ".norm.flac")
         print("'normalize' enabled!")
-        if not normTemp.exists():
-            # Creating a flac file, because it'll go faster than reading from the source.
-            # Plus, 'ffmpeg-normalize' doesn't have an option to just output one audio track.
-            print("Creating intermediate 'flac' file.")
-            normTempTemp = Path(normTemp).with_suffix(".temp.flac")
-            ffmpegRun(
-                [
-                    "ffmpeg",
-                    "-y",
-                    "-i",
-                    sourceFile,
-                    "-map",
-                    "0:{}".format(audioTrack.id),
-                    "-acodec",
-                    "flac",
-                    str(normTempTemp),
-                ],
-            )
-            normTempTemp.replace(normTemp)
+        if prefiltered:
+            # 'fanOutAudio()' already applied the pre-filter.
+            normTemp = prefiltered
         else:
-            print("Intermediate 'flac' file already exists.")
+            ffmpeg_normalize.pre_filter = ",".join(preFilter)
+            normTemp = createNormIntermediate(sourceFile, audioTrack.id, folder, label)
         print("Normalizing and converting audio using 'ffmpeg-normalize'")
         ffmpeg_normalize.add_media_file(str(normTemp), str(tempOutFile))
+        cacheLoudnessStats(
+            ffmpeg_normalize,
+            folder.joinpath(sourceFile),
+            audioTrack.id,
+            ",".join(preFilter),
+        )
         ffmpeg_normalize.run_normalization()
+        if label:
+            printProgress(label, "normalized")
     else:
-        cmd = ["ffmpeg", "-y", "-i", sourceFile]
-        cmd += ["-map", "0:{}".format(audioTrack.id)]
+        inFile, stream = getAudioInput(sourceFile, audioTrack.id, folder)
+        cmd = ["ffmpeg", "-y", "-i", inFile, "-map", stream]
         cmd += ["-c:a", audioTrack.convert["codec"]]
         if encodeOpts:
             cmd += encodeOpts
         if len(Filter) > 0:
             cmd += ["-af", ",".join(Filter)]
-        cmd += [str(tempOutFile)]
+        cmd += [tempOutFile.name]
 
         print("Converting Audio via ffmpeg")
-        ffmpegRun(cmd)
+        if ffmpegRun(cmd, cwd=folder, label=label) != 0:
+            print("Converting audio track {} failed.".format(audioTrack.index))
+            exit(1)
 
-    tempOutFile.replace(audioTrack.getOutFile())
+    tempOutFile.replace(folder.joinpath(audioTrack.getOutFile()))
+    stageJournal.finish(name, [sourceFile], dict(audioTrack), outputs)
+    if prefiltered:
+        # Only this track reads it.
+        prefiltered.unlink(missing_ok=True)
 
 
-def convertAudio(info: Info):
-    for track in info.audioInfo:
-        if track.convert:
-            convertAudioTrack(info.sourceMKV, track)
+def getFirstPasses(ffmpeg_normalize: FFmpegNormalize) -> list | None:
+    # (stream, first pass, key of its stats) of every audio stream of the media
+    # file that was just added. This reaches into the internals of
+    # 'ffmpeg-normalize', which were checked with versions 1.19 to 1.43. None
+    # when they look different, the first pass isn't cached then.
+    try:
+        streams = list(ffmpeg_normalize.media_files[-1].streams["audio"].values())
+    except (AttributeError, IndexError, KeyError, TypeError):
+        return None
+    firstPasses = []
+    for stream in streams:
+        statistics = getattr(stream, "loudness_statistics", None)
+        measure = getattr(stream, "parse_loudnorm_stats", None)
+        if not isinstance(statistics, dict) or not callable(measure):
+            return None
+        # Older 'ffmpeg-normalize' versions call the first pass stats "ebu".
+        statsKeys = [key for key in ["ebu_pass1", "ebu"] if key in statistics]
+        if not statsKeys:
+            return None
+        firstPasses.append((stream, measure, statsKeys[0]))
+    return firstPasses
+
+
+def cacheLoudnessStats(
+    ffmpeg_normalize: FFmpegNormalize, sourceFile: Path, trackId, preFilter: str
+):
+    # The first 'ffmpeg-normalize' pass measures the loudness of the whole track,
+    # which only changes when the source or the filters in front of 'normalize' do.
+    # So the measurements are kept on disk, and the first pass of the media file
+    # that was just added is swapped for one that reads them back.
+    # 'preFilter' is passed in instead of read from 'ffmpeg_normalize', because
+    # 'fanOutAudio()' applies it before 'ffmpeg-normalize' ever sees the file.
+    key = cache.hashKey(
+        {
+            "source": cache.fileFingerprint(sourceFile),
+            "track": str(trackId),
+            "preFilter": preFilter,
+            # These end up in the measured 'target_offset'.
+            "targetLevel": ffmpeg_normalize.target_level,
+            "loudnessRangeTarget": ffmpeg_normalize.loudness_range_target,
+            "truePeak": ffmpeg_normalize.true_peak,
+            "offset": getattr(ffmpeg_normalize, "offset", 0),
+            "dualMono": getattr(ffmpeg_normalize, "dual_mono", False),
+        }
+    )
+    with LOUDNESS_LOCK:
+        keyLock = LOUDNESS_KEY_LOCKS.setdefault(key, threading.Lock())
+
+    firstPasses = getFirstPasses(ffmpeg_normalize)
+    if firstPasses is None:
+        print("Not caching loudness measurements with this ffmpeg-normalize version.")
+        return
+
+    for stream, measure, statsKey in firstPasses:
+
+        def firstPass(stream=stream, measure=measure, statsKey=statsKey):
+            # Variants with the same pre-filter wait for the first one to measure.
+            with keyLock:
+                stats = cache.readCache("loudness", key)
+                if stats:
+                    print("Using cached loudness measurements for track", trackId)
+                    stream.loudness_statistics[statsKey] = stats
+                    return
+                yield from measure()
+                stats = stream.loudness_statistics.get(statsKey)
+                if stats:
+                    cache.writeCache("loudness", key, stats)
+
+        stream.parse_loudnorm_stats = firstPass
+
+
+def createNormIntermediate(
+    sourceFile: str, trackId, folder: Path, label: str = ""
+) -> Path:
+    normTemp = folder.joinpath(str(trackId) + ".norm.flac")
+    if normTemp.exists():
+        print("Intermediate 'flac' file already exists.")
+        return normTemp
+
+    # Creating a flac file, because it'll go faster than reading from the source.
+    # Plus, 'ffmpeg-normalize' doesn't have an option to just output one audio track.
+    print("Creating intermediate 'flac' file.")
+    normTempTemp = normTemp.with_suffix(".temp.flac")
+    inFile, stream = getAudioInput(sourceFile, trackId, folder)
+    returnCode = ffmpegRun(
+        [
+            "ffmpeg",
+            "-y",
+            "-i",
+            inFile,
+            "-map",
+            stream,
+            "-acodec",
+            "flac",
+            normTempTemp.name,
+        ],
+        cwd=folder,
+        label=label,
+    )
+    if returnCode != 0:
+        normTempTemp.unlink(missing_ok=True)
+        print("Creating the intermediate 'flac' of track {} failed.".format(trackId))
+        exit(1)
+    normTempTemp.replace(normTemp)
+    return normTemp
+
+
+def getAudioInput(sourceFile: str, trackId, folder: Path) -> tuple[str, str]:
+    # Input file and stream of a source audio track for ffmpeg. The file the
+    # 'extract' stage demuxed for it is a lot smaller than the source.
+    for demuxFile in folder.glob(DEMUX_FILE.format(trackId, "*")):
+        return demuxFile.name, "0:0"
+    return sourceFile, "0:{}".format(trackId)
+
+
+def isNormalized(audioTrack: AudioTrackInfo) -> bool:
+    if "filters" not in audioTrack.convert:
+        return False
+    return any("normalize" in ffFilter for ffFilter in audioTrack.convert["filters"])
+
+
+def fanOutAudio(
+    sourceFile: str, tracks: list[AudioTrackInfo], folder: Path
+) -> dict[int, Path]:
+    # Every track reads the same source stream, so decode it once and
+    # 'asplit' it into each track's filter chain.
+    # Tracks that get normalized are written as pre-filtered 'flac' files
+    # for 'ffmpeg-normalize', the other tracks are converted right away.
+    # Returns the pre-filtered file of each normalized track by track index.
+    trackId = tracks[0].id
+    stageJournal = journal.getJournal(folder)
+    inFile, stream = getAudioInput(sourceFile, trackId, folder)
+    prefiltered: dict[int, Path] = {}
+    finished: list[AudioTrackInfo] = []
+    renames: list[tuple[Path, Path]] = []
+    graph: list[str] = []
+    outputs: list[str] = []
+
+    for track in tracks:
+        preFilter, normalize, Filter = getAudioFilters(track)
+        if normalize is not None:
+            prenormKey = cache.hashKey(
+                {
+                    "input": cache.fileFingerprint(folder.joinpath(inFile)),
+                    "stream": stream,
+                    "preFilter": preFilter,
+                }
+            )
+            prenorm = folder.joinpath(
+                PRENORM_FILE.format(track.id, track.index, prenormKey[:16])
+            )
+            # Made with other filters or from another source.
+            for oldFile in folder.glob(PRENORM_FILE.format(track.id, track.index, "*")):
+                if oldFile != prenorm:
+                    oldFile.unlink()
+            prefiltered[track.index] = prenorm
+            if prenorm.exists():
+                continue
+            chain = preFilter
+            tempOut = prenorm.with_suffix(".temp.flac")
+            outputOpts = ["-c:a", "flac"]
+            renames.append((tempOut, prenorm))
+        else:
+            chain = Filter
+            tempOut = folder.joinpath("temp-" + track.getOutFile())
+            outputOpts = ["-c:a", track.convert["codec"]]
+            if "encodeOpts" in track.convert and track.convert["encodeOpts"]:
+                outputOpts += track.convert["encodeOpts"]
+            renames.append((tempOut, folder.joinpath(track.getOutFile())))
+            finished.append(track)
+            stageJournal.start("audio:" + track.getOutFile())
+
+        link = len(graph)
+        graph.append("[s{}]{}[o{}]".format(link, ",".join(chain) or "anull", link))
+        outputs += ["-map", "[o{}]".format(link)] + outputOpts + [tempOut.name]
+
+    if not graph:
+        return prefiltered
+
+    splits = "".join("[s{}]".format(i) for i in range(len(graph)))
+    graph.insert(0, "[{}]asplit={}{}".format(stream, len(graph), splits))
+
+    print(
+        "Converting {} audio tracks from one decode of track {}.".format(
+            len(graph) - 1, trackId
+        )
+    )
+    cmd = ["ffmpeg", "-y", "-i", inFile, "-filter_complex", ";".join(graph)]
+    cmd += outputs
+    if ffmpegRun(cmd, cwd=folder, label="{} fan-out".format(trackId)) != 0:
+        print("Fan-out of audio track {} failed.".format(trackId))
+        exit(1)
+
+    for tempOut, outFile in renames:
+        tempOut.replace(outFile)
+    for track in finished:
+        stageJournal.finish(
+            "audio:" + track.getOutFile(),
+            [sourceFile],
+            dict(track),
+            [track.getOutFile()],
+        )
+
+    return prefiltered
+
+
+def convertAudio(info: Info, audioJobs: int = AUDIO_JOBS, audioFanout: bool = False):
+    tracks = [track for track in info.audioInfo if track.convert]
+    if (audioJobs <= 1 or len(tracks) <= 1) and not audioFanout:
+        for track in tracks:
+            convertAudioTrack(info.sourceMKV, track, info.folder)
+        return
+
+    stageJournal = journal.getJournal(info.folder)
+    tracks = [
+        track
+        for track in tracks
+        if not stageJournal.isDone(
+            "audio:" + track.getOutFile(),
+            [info.sourceMKV],
+            dict(track),
+            [track.getOutFile()],
+        )
+    ]
+
+    # Tracks that are made from the same source track (like the 'nightmode'
+    # tracks) can share a single decode of that track.
+    groups: dict[str, list[AudioTrackInfo]] = {}
+    if audioFanout:
+        for track in tracks:
+            groups.setdefault(str(track.id), []).append(track)
+        groups = {key: group for key, group in groups.items() if len(group) > 1}
+    fannedOut = [track.index for group in groups.values() for track in group]
+
+    audioJobs = max(1, audioJobs)
+    print("Converting {} audio tracks, {} at a time.".format(len(tracks), audioJobs))
+    with ThreadPoolExecutor(
+        max_workers=audioJobs,
+        initializer=resources.setStage,
+        initargs=(resources.currentStage(),),
+    ) as executor:
+        groupFutures = [
+            executor.submit(fanOutAudio, info.sourceMKV, group, info.folder)
+            for group in groups.values()
+        ]
+
+        # Normalized tracks of the same source id share one intermediate 'flac',
+        # so create those before the tracks that read them start.
+        normIds = sorted(
+            {
+                str(track.id)
+                for track in tracks
+                if isNormalized(track) and track.index not in fannedOut
+            }
+        )
+        futures = [
+            executor.submit(
+                createNormIntermediate,
+                info.sourceMKV,
+                trackId,
+                info.folder,
+                "{}.norm.flac".format(trackId),
+            )
+            for trackId in normIds
+        ]
+        for future in futures:
+            future.result()
+
+        prefiltered: dict[int, Path] = {}
+        for future in groupFutures:
+            prefiltered.update(future.result())
+
+        futures = [
+            executor.submit(
+                convertAudioTrack,
+                info.sourceMKV,
+                track,
+                info.folder,
+                track.getOutFile(),
+                prefiltered.get(track.index),
+            )
+            for track in tracks
+            if track.index not in fannedOut or track.index in prefiltered
+        ]
+        for future in futures:
+            future.result()
 
 
 def extractTracks(info: Info):
     sourceFile = info.sourceMKV
+    stageJournal = journal.getJournal(info.folder)
+
+    def isExtracted(track) -> bool:
+        name = "extract:" + track.getOutFile()
+        if stageJournal.isDone(name, [sourceFile], dict(track), [track.getOutFile()]):
+            print(track.getOutFile(), "already exists! skipping...")
+            return True
+        return False
+
     tracks = []
     for track in info.audioInfo:
-        if Path(track.getOutFile()).exists():
-            print(track.getOutFile(), "already exists! skipping...")
-            continue
         if track.convert:
             continue
+        if isExtracted(track):
+            continue
         tracks.append(track)
     for track in info.subInfo:
-        if Path(track.getOutFile()).exists():
-            print(track.getOutFile(), "already exists! skipping...")
-            continue
         if track.sup2srt:
             continue
         if track.srtFilter:
             continue
         if track.external:
             continue
+        if isExtracted(track):
+            continue
         tracks.append(track)
 
-    if len(tracks) == 0:
+    # Every source track the audio stage still converts is demuxed in the same
+    # pass, so the conversions don't each read the whole source again.
+    demuxFiles = getDemuxFiles(info)
+    for trackId, demuxFile in list(demuxFiles.items()):
+        name = "demux:{}".format(trackId)
+        if stageJournal.isDone(name, [sourceFile], {"id": trackId}, [demuxFile]):
+            demuxFiles.pop(trackId)
+        else:
+            for oldFile in info.folder.glob(DEMUX_FILE.format(trackId, "*")):
+                oldFile.unlink()
+
+    if len(tracks) == 0 and len(demuxFiles) == 0:
         return 0
 
     tempTracks = []
 
-    cmd = ["mkvextract", sourceFile, "tracks"]
+    cmd = ["mkvextract", "--gui-mode", sourceFile, "tracks"]
     for track in tracks:
-        tempOut = Path("temp-" + track.getOutFile())
-        cmd += ["{}:{}".format(track.id, tempOut)]
+        tempOut = info.getPath("temp-" + track.getOutFile())
+        cmd += ["{}:{}".format(track.id, tempOut.name)]
         tempTracks.append(tempOut)
+    for trackId, demuxFile in demuxFiles.items():
+        cmd += ["{}:temp-{}".format(trackId, demuxFile)]
 
     cmd += ["chapters", "chapters.xml"]
 
+    for track in tracks:
+        stageJournal.start("extract:" + track.getOutFile())
+    for trackId in demuxFiles:
+        stageJournal.start("demux:{}".format(trackId))
+
     print("\nExtracting tracks via mkvextract.")
     print(" ".join(cmd))
-    p = sp.Popen(cmd)
-    p.communicate()
+    p = popen(cmd, stdout=sp.PIPE, cwd=info.folder)
+    progress.run(p, p.stdout, "extract", "mkvextract", progress.parseMkvToolNix)
+    # 1 is only a warning.
+    if p.returncode not in [0, 1]:
+        print("mkvextract failed.")
+        exit(1)
 
     for i in range(len(tracks)):
-        tempTracks[i].replace(tracks[i].getOutFile())
+        tempTracks[i].replace(info.getPath(tracks[i].getOutFile()))
+        stageJournal.finish(
+            "extract:" + tracks[i].getOutFile(),
+            [sourceFile],
+            dict(tracks[i]),
+            [tracks[i].getOutFile()],
+        )
+    for trackId, demuxFile in demuxFiles.items():
+        info.getPath("temp-" + demuxFile).replace(info.getPath(demuxFile))
+        stageJournal.finish(
+            "demux:{}".format(trackId), [sourceFile], {"id": trackId}, [demuxFile]
+        )
+
+
+def getDemuxFiles(info: Info) -> dict[int, str]:
+    # Demux file of every source track that audio tracks still get made from.
+    stageJournal = journal.getJournal(info.folder)
+    trackIds = {
+        int(track.id)
+        for track in info.audioInfo
+        if track.convert
+        and not stageJournal.isDone(
+            "audio:" + track.getOutFile(),
+            [info.sourceMKV],
+            dict(track),
+            [track.getOutFile()],
+        )
+    }
+    if not trackIds:
+        return {}
+
+    try:
+        streams = probecache.probe(str(info.getPath(info.sourceMKV)))["streams"]
+    except (sp.CalledProcessError, OSError, KeyError, ValueError):
+        return {}
+    demuxFiles = {}
+    for trackId in sorted(trackIds):
+        if trackId >= len(streams):
+            continue
+        extension = DEMUX_EXTENSIONS.get(streams[trackId].get("codec_name", ""))
+        if extension:
+            demuxFiles[trackId] = DEMUX_FILE.format(trackId, extension)
+    return demuxFiles
 
 
 def selectKeyFromDict(d: dict):
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# Measures how many frames per second the VapourSynth -> encoder pipe can
+# move, without an actual encoder. Frames come from 'std.BlankClip' (so
+# nothing is decoded or filtered) and go to a null encoder that only reads
+# them ('cat' into /dev/null by default).
+#
+# If this is barely faster than x265 with the preset you use, the pipe is
+# what limits the encode, and '--raw-frames' of 'batchconvert.py' helps.
+#
+# Example: ./benchmarks/frametransport.py --width 3840 --height 2160 --frames 500
+#
+import argparse
+import subprocess as sp
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import vapoursynth as vs
+from utils import transport
+
+FORMATS = {
+    "yuv420p8": vs.YUV420P8,
+    "yuv420p10": vs.YUV420P10,
+    "yuv444p10": vs.YUV444P10,
+}
+
+
+def runMode(video, consumer: list[str], mode: str) -> float:
+    if mode == "y4m":
+        # What 'batchconvert.py' did before: default pipe, buffered writer.
+        process = sp.Popen(consumer, stdin=sp.PIPE, stdout=sp.DEVNULL)
+        start = time.perf_counter()
+        video.output(process.stdin, y4m=True)
+    else:
+        process = sp.Popen(consumer, stdin=sp.PIPE, stdout=sp.DEVNULL, bufsize=0)
+        start = time.perf_counter()
+        transport.outputFrames(video, process.stdin, mode == "raw")
+    process.stdin.close()
+    process.wait()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog=sys.argv[0],
+        description="Benchmark frame transport from VapourSynth to an encoder.",
+    )
+    parser.add_argument("--width", type=int, default=3840)
+    parser.add_argument("--height", type=int, default=2160)
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--format", choices=list(FORMATS), default="yuv420p10")
+    parser.add_argument(
+        "--consumer",
+        default="cat",
+        help="Command that reads the frames from stdin. (default: cat)",
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=["y4m", "y4m-pipe", "raw"],
+        default=["y4m", "y4m-pipe", "raw"],
+        help="y4m: old transport, y4m-pipe: bigger pipe, raw: bigger pipe and no Y4M",
+    )
+    args = parser.parse_args()
+
+    video = vs.core.std.BlankClip(
+        width=args.width,
+        height=args.height,
+        format=FORMATS[args.format],
+        length=args.frames,
+    )
+    fmt = video.format
+    chromaSize = (args.width >> fmt.subsampling_w) * (args.height >> fmt.subsampling_h)
+    frameSize = (args.width * args.height + 2 * chromaSize) * fmt.bytes_per_sample
+    print(
+        "{} frames of {}x{} {}, {:.1f}MB per frame".format(
+            args.frames, args.width, args.height, args.format, frameSize / 1e6
+        )
+    )
+
+    for mode in args.modes:
+        seconds = runMode(video, args.consumer.split(), mode)
+        print(
+            "{:<9} {:8.1f} fps {:8.1f} MB/s".format(
+                mode,
+                args.frames / seconds,
+                args.frames * frameSize / seconds / 1e6,
+            )
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
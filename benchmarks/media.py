@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+#
+# Synthetic Blu-ray like sources for the benchmarks.
+#
+# Everything is made with ffmpeg's lavfi sources, except the PGS subtitles,
+# which ffmpeg can't encode. Those are written here: every caption is a
+# display set (PCS, WDS, PDS, ODS, END) showing a plain bar, followed by a
+# display set that clears it. 'readPGS()' is the reverse, for the fake tools.
+#
+import struct
+import subprocess as sp
+from pathlib import Path
+
+# Segment types of a PGS stream.
+PDS = 0x14
+ODS = 0x15
+PCS = 0x16
+WDS = 0x17
+END = 0x80
+PGS_CLOCK = 90000
+# 'cropped_flag' bit of a composition object that marks it as forced.
+FORCED_FLAG = 0x40
+
+# Codec and bitrate of each synthetic audio layout, close to what is on Blu-rays.
+AUDIO_CODECS = {
+    "7.1": ("pcm_s24le", ""),
+    "5.1": ("ac3", "640k"),
+    "stereo": ("ac3", "224k"),
+    "mono": ("ac3", "96k"),
+}
+CHANNELS = {"7.1": 8, "5.1": 6, "stereo": 2, "mono": 1}
+LANGUAGES = ["eng", "fre", "ger", "spa"]
+
+
+def segment(segmentType: int, pts: int, payload: bytes) -> bytes:
+    return b"PG" + struct.pack(">IIBH", pts, 0, segmentType, len(payload)) + payload
+
+
+def encodeBar(width: int, height: int, color: int = 1) -> bytes:
+    # Run length encoded lines of one color.
+    line = bytes([0, 0xC0 | (width >> 8), width & 0xFF, color, 0, 0])
+    return line * height
+
+
+def displaySet(
+    pts: int,
+    number: int,
+    videoSize: tuple[int, int],
+    forced: bool = False,
+    clear: bool = False,
+) -> bytes:
+    videoWidth, videoHeight = videoSize
+    width, height = videoWidth // 3, max(2, videoHeight // 20)
+    x, y = (videoWidth - width) // 2, videoHeight - height * 3
+
+    state = 0x00 if clear else 0x80
+    pcs = struct.pack(">HHBHBBB", videoWidth, videoHeight, 0x10, number, state, 0, 0)
+    if clear:
+        pcs += bytes([0])
+    else:
+        pcs += bytes([1]) + struct.pack(
+            ">HBBHH", 0, 0, FORCED_FLAG if forced else 0, x, y
+        )
+    data = segment(PCS, pts, pcs)
+    data += segment(WDS, pts, struct.pack(">BBHHHH", 1, 0, x, y, width, height))
+    if not clear:
+        palette = bytes([0, 0]) + bytes([1, 235, 128, 128, 255])
+        data += segment(PDS, pts, palette)
+        rle = encodeBar(width, height)
+        ods = struct.pack(">HBB", 0, 0, 0xC0)
+        ods += (len(rle) + 4).to_bytes(3, "big") + struct.pack(">HH", width, height)
+        data += segment(ODS, pts, ods + rle)
+    data += segment(END, pts, b"")
+    return data
+
+
+def writePGS(
+    path: Path,
+    duration: float,
+    videoSize: tuple[int, int],
+    interval: float = 4.0,
+    length: float = 2.0,
+    forcedEvery: int = 0,
+):
+    # A caption every 'interval' seconds, every 'forcedEvery'th one forced.
+    data = b""
+    number = 0
+    start = 0.5
+    while start + length < duration:
+        forced = forcedEvery > 0 and number % forcedEvery == 0
+        data += displaySet(int(start * PGS_CLOCK), number * 2, videoSize, forced)
+        end = int((start + length) * PGS_CLOCK)
+        data += displaySet(end, number * 2 + 1, videoSize, clear=True)
+        number += 1
+        start += interval
+    Path(path).write_bytes(data)
+
+
+def readPGS(path: Path) -> list[tuple[int, int, bytes]]:
+    # List of (pts, segment type, payload).
+    data = Path(path).read_bytes()
+    segments = []
+    offset = 0
+    while offset + 13 <= len(data) and data[offset : offset + 2] == b"PG":
+        pts, _, segmentType, size = struct.unpack_from(">IIBH", data, offset + 2)
+        segments.append((pts, segmentType, data[offset + 13 : offset + 13 + size]))
+        offset += 13 + size
+    return segments
+
+
+def writeSegments(path: Path, segments: list[tuple[int, int, bytes]]):
+    Path(path).write_bytes(b"".join(segment(t, pts, p) for pts, t, p in segments))
+
+
+def isForced(pcs: bytes) -> bool:
+    # 11 bytes of PCS header, then 8 bytes per object with the flags at 3.
+    return any(pcs[11 + i * 8 + 3] & FORCED_FLAG for i in range(pcs[10]))
+
+
+def captions(segments: list[tuple[int, int, bytes]]) -> list[dict]:
+    # Display sets that show something, together with the one clearing them:
+    # [{"start": pts, "end": pts, "forced": bool, "segments": [...]}, ...]
+    result = []
+    displaySet = []
+    for pts, segmentType, payload in segments:
+        displaySet.append((pts, segmentType, payload))
+        if segmentType != END:
+            continue
+        pcs = displaySet[0][2]
+        if pcs[10] > 0:
+            result.append(
+                {"start": pts, "end": pts, "forced": isForced(pcs), "segments": []}
+            )
+        if result:
+            result[-1]["end"] = pts
+            result[-1]["segments"] += displaySet
+        displaySet = []
+    return result
+
+
+def writeChapters(path: Path, duration: float, interval: float = 300.0):
+    lines = [";FFMETADATA1"]
+    start = 0.0
+    number = 1
+    while start < duration:
+        end = min(duration, start + interval)
+        lines += [
+            "[CHAPTER]",
+            "TIMEBASE=1/1000",
+            "START={}".format(int(start * 1000)),
+            "END={}".format(int(end * 1000)),
+            "title=Chapter {:02d}".format(number),
+        ]
+        start = end
+        number += 1
+    Path(path).write_text("\n".join(lines) + "\n")
+
+
+def hasEncoder(name: str) -> bool:
+    output = sp.run(
+        ["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True
+    ).stdout
+    return any(line.split()[1:2] == [name] for line in output.splitlines())
+
+
+def makeSource(
+    outFile: Path,
+    duration: float = 60.0,
+    size: tuple[int, int] = (1920, 1080),
+    audioLayouts: list[str] = ["7.1", "5.1", "stereo"],
+    subtitleTracks: int = 2,
+):
+    # Video, one audio track per layout, PGS tracks (the first one with some
+    # forced captions), and chapters every 5 minutes.
+    outFile = Path(outFile)
+    workDir = outFile.parent
+    width, height = size
+    videoCodec = ["libx264", "-preset", "ultrafast", "-crf", "30"]
+    if not hasEncoder("libx264"):
+        videoCodec = ["mpeg2video", "-q:v", "10"]
+
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error"]
+    cmd += [
+        "-f",
+        "lavfi",
+        "-i",
+        "testsrc2=size={}x{}:rate=24000/1001:duration={}".format(
+            width, height, duration
+        ),
+    ]
+    for i, layout in enumerate(audioLayouts):
+        # A different tone on every channel.
+        tones = "|".join(
+            "0.2*sin({}*2*PI*t)".format(220 * (i + 1) + 110 * c)
+            for c in range(CHANNELS[layout])
+        )
+        source = "aevalsrc='{}':channel_layout={}:sample_rate=48000:duration={}"
+        cmd += ["-f", "lavfi", "-i", source.format(tones, layout, duration)]
+
+    supFiles = []
+    for i in range(subtitleTracks):
+        supFile = workDir.joinpath("synthetic-{}.sup".format(i))
+        writePGS(supFile, duration, size, forcedEvery=5 if i == 0 else 0)
+        supFiles.append(supFile)
+        cmd += ["-i", str(supFile)]
+    chaptersFile = workDir.joinpath("synthetic-chapters.txt")
+    writeChapters(chaptersFile, duration)
+    cmd += ["-i", str(chaptersFile)]
+
+    inputs = 1 + len(audioLayouts) + len(supFiles)
+    for i in range(inputs):
+        cmd += ["-map", "{}:0".format(i)]
+    cmd += ["-map_chapters", str(inputs), "-map_metadata", "-1"]
+    cmd += ["-c:v"] + videoCodec
+    for i, layout in enumerate(audioLayouts):
+        codec, bitrate = AUDIO_CODECS[layout]
+        cmd += ["-c:a:{}".format(i), codec]
+        if bitrate:
+            cmd += ["-b:a:{}".format(i), bitrate]
+        cmd += ["-metadata:s:a:{}".format(i), "language=" + LANGUAGES[i % 4]]
+    for i in range(len(supFiles)):
+        cmd += ["-metadata:s:s:{}".format(i), "language=" + LANGUAGES[i % 4]]
+    cmd += ["-c:s", "copy", "-metadata", "title=Synthetic", str(outFile)]
+    sp.run(cmd, check=True)
+
+    for path in supFiles + [chaptersFile]:
+        path.unlink()
+    return outFile
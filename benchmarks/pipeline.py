@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+#
+# End to end benchmark of 'batchconvert.py' that needs no Blu-rays.
+#
+# Makes synthetic 'source.mkv' files (see 'media.py'), creates their
+# 'info.json' with the 'config' subcommand, converts them, and reports the
+# wall time of every stage and tool from the '--progress-json' events.
+# By default x265, sup2srt, dovi_tool, and hdr10plus_tool are replaced with
+# the stand-ins in 'faketools/', so what is measured is mostly the
+# orchestration around them. ffmpeg, mkvtoolnix, VapourSynth (with ffms2),
+# and the python dependencies of 'batchconvert.py' have to be installed.
+#
+# Example: ./benchmarks/pipeline.py --titles 3 --jobs 2 --duration 120
+#
+import argparse
+import json
+import os
+import shutil
+import subprocess as sp
+import sys
+import time
+from pathlib import Path
+
+import media
+
+REPO = Path(__file__).resolve().parents[1]
+BATCHCONVERT = REPO.joinpath("batchconvert.py")
+FAKE_TOOLS = Path(__file__).resolve().parent.joinpath("faketools")
+REQUIRED_TOOLS = ["ffmpeg", "ffprobe", "mkvmerge", "mkvextract"]
+PROGRESS_FILE = "progress.jsonl"
+LOG_FILE = "benchmark.log"
+
+
+def makeX265Template(path: Path, size: tuple[int, int]):
+    # What the fake x265 writes, mkvmerge needs a real HEVC stream.
+    sp.run(
+        [
+            "ffmpeg",
+            "-y",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            "testsrc2=size={}x{}:rate=24000/1001:duration=1".format(*size),
+            "-c:v",
+            "libx265",
+            "-x265-params",
+            "log-level=error",
+            "-f",
+            "hevc",
+            str(path),
+        ],
+        check=True,
+    )
+
+
+def prepareTitle(folder: Path, args, reuse: bool) -> dict:
+    timings = {}
+    sourceFile = folder.joinpath("source.mkv")
+    if reuse and sourceFile.exists():
+        for file in folder.iterdir():
+            if file.is_dir():
+                shutil.rmtree(file)
+            elif file != sourceFile:
+                file.unlink()
+    else:
+        shutil.rmtree(folder, ignore_errors=True)
+        folder.mkdir(parents=True)
+        start = time.monotonic()
+        media.makeSource(
+            sourceFile, args.duration, args.size, args.audio, args.subtitles
+        )
+        timings["generate"] = time.monotonic() - start
+
+    cmd = [sys.executable, str(BATCHCONVERT), "config", sourceFile.name]
+    cmd += ["--title", folder.name, "--output", folder.name + ".mkv"]
+    cmd += ["--config", "info.json"]
+    if args.subtitles and args.sup2srt:
+        # The first subtitle track comes after the video and audio tracks.
+        cmd += ["--sup2srt", str(1 + len(args.audio))]
+    start = time.monotonic()
+    sp.run(cmd, cwd=folder, check=True, stdout=sp.DEVNULL)
+    timings["config"] = time.monotonic() - start
+    return timings
+
+
+def readEvents(progressFile: Path) -> list[dict]:
+    events = []
+    if not progressFile.exists():
+        return events
+    for line in progressFile.read_text().splitlines():
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            pass
+    return events
+
+
+def summarize(events: list[dict]) -> tuple[dict, dict]:
+    # Stage wall times per title, and how long every tool ran per stage.
+    stages: dict[str, dict] = {}
+    tools: dict[str, dict] = {}
+    started = {}
+    for event in events:
+        title = event.get("title", "")
+        if event["tool"] == "stages":
+            stages.setdefault(title, {})[event["stage"]] = event["seconds"]
+            continue
+        key = (title, event["stage"], event["tool"])
+        if event["status"] == "running":
+            started.setdefault(key, event["time"])
+        elif key in started:
+            seconds = event["time"] - started.pop(key)
+            name = "{} ({})".format(event["stage"], event["tool"])
+            tools.setdefault(title, {})[name] = round(seconds, 3)
+    return stages, tools
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog=sys.argv[0],
+        description="Benchmark 'batchconvert.py' on synthetic sources.",
+    )
+    parser.add_argument("--workdir", type=Path, default=Path("benchmark-work"))
+    parser.add_argument("--titles", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds.")
+    parser.add_argument(
+        "--size",
+        type=lambda s: tuple(int(x) for x in s.split("x")),
+        default=(1920, 1080),
+        help="Video size, like '1920x1080'.",
+    )
+    parser.add_argument(
+        "--audio",
+        nargs="+",
+        choices=list(media.AUDIO_CODECS),
+        default=["7.1", "5.1", "stereo"],
+        help="Layout of every audio track.",
+    )
+    parser.add_argument("--subtitles", type=int, default=2, help="PGS tracks.")
+    parser.add_argument(
+        "--sup2srt",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="OCR the first subtitle track.",
+    )
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument(
+        "--fake-tools",
+        dest="fakeTools",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+        help="Use the stand-ins in 'benchmarks/faketools/'.",
+    )
+    parser.add_argument(
+        "--x265-fps",
+        dest="x265Fps",
+        type=float,
+        default=0,
+        help="Frames per second of the fake x265 (default: as fast as possible).",
+    )
+    parser.add_argument(
+        "--ocr-seconds",
+        dest="ocrSeconds",
+        type=float,
+        default=0,
+        help="Seconds the fake sup2srt takes per caption.",
+    )
+    parser.add_argument(
+        "--reuse-sources",
+        dest="reuse",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="Keep 'source.mkv' files from the last run.",
+    )
+    parser.add_argument(
+        "--output", type=Path, help="Write the results to this json file."
+    )
+    parser.add_argument(
+        "batchconvertArgs",
+        nargs=argparse.REMAINDER,
+        help="Extra arguments for 'batchconvert.py' (after '--').",
+    )
+    args = parser.parse_args()
+
+    missing = [tool for tool in REQUIRED_TOOLS if not shutil.which(tool)]
+    if missing:
+        print("Missing: {}".format(", ".join(missing)))
+        return 1
+
+    workdir = args.workdir.resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    # 'config' and the conversion have to find the fake tools too.
+    if args.fakeTools:
+        template = workdir.joinpath("x265-template.hevc")
+        if not media.hasEncoder("libx265"):
+            print("The fake x265 needs an ffmpeg with libx265.")
+            return 1
+        makeX265Template(template, args.size)
+        os.environ["PATH"] = str(FAKE_TOOLS) + os.pathsep + os.environ["PATH"]
+        os.environ["FAKE_X265_TEMPLATE"] = str(template)
+        os.environ["FAKE_X265_FPS"] = str(args.x265Fps)
+        os.environ["FAKE_OCR_SECONDS"] = str(args.ocrSeconds)
+
+    results = {"settings": {k: str(v) for k, v in vars(args).items()}, "titles": {}}
+    for i in range(args.titles):
+        folder = workdir.joinpath("title-{:02d}".format(i + 1))
+        print("Preparing", folder.name)
+        results["titles"][folder.name] = prepareTitle(folder, args, args.reuse)
+        workdir.joinpath(folder.name + ".mkv").unlink(missing_ok=True)
+
+    progressFile = workdir.joinpath(PROGRESS_FILE)
+    progressFile.unlink(missing_ok=True)
+    extraArgs = [arg for arg in args.batchconvertArgs if arg != "--"]
+    cmd = [sys.executable, str(BATCHCONVERT), "--jobs", str(args.jobs)]
+    cmd += ["--progress-json", str(progressFile)] + extraArgs
+    print("Converting:", " ".join(cmd))
+    start = time.monotonic()
+    with open(workdir.joinpath(LOG_FILE), "w") as log:
+        returncode = sp.run(cmd, cwd=workdir, stdout=log, stderr=sp.STDOUT).returncode
+    results["convert"] = time.monotonic() - start
+    results["returncode"] = returncode
+
+    stages, tools = summarize(readEvents(progressFile))
+    for title, timings in results["titles"].items():
+        timings["stages"] = stages.get(title, {})
+        timings["tools"] = tools.get(title, {})
+
+    for title, timings in results["titles"].items():
+        print("\n" + title)
+        for name in ["generate", "config"]:
+            if name in timings:
+                print("  {:<32} {:8.2f}s".format(name, timings[name]))
+        for name, seconds in timings["stages"].items():
+            print("  stage {:<26} {:8.2f}s".format(name, seconds))
+        for name, seconds in timings["tools"].items():
+            print("    {:<28} {:8.2f}s".format(name, seconds))
+    print(
+        "\nConverting took {:.2f}s (exit status {}, log: {})".format(
+            results["convert"], returncode, workdir.joinpath(LOG_FILE)
+        )
+    )
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+    return 0 if returncode == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
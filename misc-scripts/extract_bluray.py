@@ -4,6 +4,11 @@ from pathlib import Path
 import subprocess as sp
 import json
 import shutil
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from utils import progress
 
 
 def main():
@@ -151,23 +156,17 @@ def batchCreateMKVs(BluRayDir, titles, outFile):
             continue
         outputTemp = output.with_name("temp-" + outFile)
 
-        cmd = ["mkvmerge", "--output", str(outputTemp), str(inFile)]
+        cmd = ["mkvmerge", "--gui-mode", "--output", str(outputTemp), str(inFile)]
 
         print("Running: ", end="")
         for x in cmd:
             print(x, end=" ")
         print()
-        p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.DEVNULL, universal_newlines=True)
-        if not p.stdout:
+        p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.DEVNULL)
+        progress.run(p, p.stdout, title["folder"], "mkvmerge", progress.parseMkvToolNix)
+        if p.returncode not in [0, 1]:
             print("Oof!! Something must of broke!")
             exit(1)
-
-        for line in p.stdout:
-            line = line.rstrip()
-            if "Progress:" in line:
-                print(f"{line}\r", end="")
-                # Clean the rest of the line.
-                print("\033[K", end="")
         counter += 1
         outputTemp.replace(output)
 
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Small helpers for results that are kept on disk between runs.
+#
+# Everything lives in '$XDG_CACHE_HOME/python-media-scripts/<name>/'
+# (or '~/.cache/...'), one json file per key.
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+
+def cacheDir(name: str) -> Path:
+    base = os.environ.get("XDG_CACHE_HOME", "")
+    if not base:
+        base = str(Path.home().joinpath(".cache"))
+    path = Path(base, "python-media-scripts", name)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def fileFingerprint(path) -> dict:
+    # Hashing a 60GB remux takes longer than most of the things we cache,
+    # so a file is considered unchanged while its path, size, and mtime are.
+    path = Path(path).resolve()
+    stat = path.stat()
+    return {"path": str(path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def hashKey(data) -> str:
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def readCache(name: str, key: str):
+    path = cacheDir(name).joinpath(key + ".json")
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def writeCache(name: str, key: str, data):
+    path = cacheDir(name).joinpath(key + ".json")
+    tempPath = path.with_name(
+        "{}.{}.{}.tmp".format(path.name, os.getpid(), threading.get_ident())
+    )
+    tempPath.write_text(json.dumps(data))
+    tempPath.replace(path)
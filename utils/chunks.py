@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Helpers for encoding a video as separate chunks that get joined together
+# afterwards. Chunks start on scene cuts or keyframes of the source when
+# possible (see 'sceneindex.py'), so the forced IDR frame at the start of a
+# chunk doesn't cost much.
+#
+# HDR10+ and Dolby Vision metadata are per frame, so they have to be cut
+# up the same way as the video.
+import json
+import math
+import shutil
+import subprocess as sp
+from pathlib import Path
+
+try:
+    import stages
+except:
+    from utils import stages
+
+# Aim for a few chunks per worker, so workers that got easy chunks
+# don't sit idle at the end.
+CHUNKS_PER_WORKER = 4
+MIN_CHUNK_FRAMES = 1000
+
+
+def scaleKeyframes(
+    keyframes: list[int], sourceFrames: int, numFrames: int
+) -> list[int]:
+    # The vapoursynth script might change the frame count (decimation, trimming),
+    # in that case the keyframes can only be a rough guide.
+    if sourceFrames == numFrames or sourceFrames == 0:
+        return list(keyframes)
+    return sorted({round(k * numFrames / sourceFrames) for k in keyframes})
+
+
+def planChunks(
+    numFrames: int,
+    keyframes: list[int],
+    workers: int,
+    minFrames: int = MIN_CHUNK_FRAMES,
+    targetFrames: int = 0,
+) -> list[tuple[int, int]]:
+    # Returns a list of (first frame, last frame + 1).
+    # 'targetFrames' overrides the chunk length picked from the number of workers.
+    target = targetFrames
+    if not target:
+        target = math.ceil(numFrames / max(1, workers * CHUNKS_PER_WORKER))
+    target = max(minFrames, target)
+    keyframes = sorted(k for k in keyframes if 0 < k < numFrames)
+
+    chunks = []
+    start = 0
+    i = 0
+    while start < numFrames:
+        ideal = start + target
+        if numFrames - start < target + minFrames:
+            chunks.append((start, numFrames))
+            break
+
+        # First keyframe at or after the ideal split, unless that makes
+        # the chunk a lot longer than it should be.
+        while i < len(keyframes) and keyframes[i] < ideal:
+            i += 1
+        end = ideal
+        if i < len(keyframes) and keyframes[i] < start + 2 * target:
+            end = keyframes[i]
+        if numFrames - end < minFrames:
+            end = numFrames
+
+        chunks.append((start, end))
+        start = end
+
+    return chunks
+
+
+def sliceHDR10PlusJson(inFile: str, outFile: str, start: int, end: int):
+    # 'hdr10plus_tool' json has one 'SceneInfo' entry per frame.
+    data = json.loads(Path(inFile).read_text())
+    frames = []
+    sceneStarts: list[int] = []
+    sceneLengths: list[int] = []
+    lastScene = None
+
+    for i, frame in enumerate(data["SceneInfo"][start:end]):
+        frame = dict(frame)
+        if frame.get("SceneId") != lastScene or not sceneStarts:
+            lastScene = frame.get("SceneId")
+            sceneStarts.append(i)
+            sceneLengths.append(0)
+        sceneLengths[-1] += 1
+        frame["SceneId"] = len(sceneStarts) - 1
+        frame["SceneFrameIndex"] = i - sceneStarts[-1]
+        frame["SequenceFrameIndex"] = i
+        frames.append(frame)
+
+    data["SceneInfo"] = frames
+    if "SceneInfoSummary" in data:
+        data["SceneInfoSummary"] = {
+            "SceneFirstFrameIndex": sceneStarts,
+            "SceneFrameNumbers": sceneLengths,
+        }
+    Path(outFile).write_text(json.dumps(data))
+
+
+def sliceDoviRPU(
+    inFile: str, outFile: str, start: int, end: int, totalFrames: int, doviTool: str
+):
+    remove = []
+    # Cut the end first, so the frame numbers of the start stay the same.
+    if end < totalFrames:
+        remove.append("{}-{}".format(end, totalFrames - 1))
+    if start > 0:
+        remove.append("{}-{}".format(0, start - 1))
+
+    if not remove:
+        shutil.copyfile(inFile, outFile)
+        return
+
+    editFile = Path(outFile).with_suffix(".edit.json")
+    editFile.write_text(json.dumps({"remove": remove}))
+    cmd = [doviTool, "editor", "-i", inFile, "-j", str(editFile), "--rpu-out", outFile]
+    returncode = stages.popen(cmd, stdout=sp.DEVNULL).wait()
+    if returncode != 0:
+        raise sp.CalledProcessError(returncode, cmd)
+    editFile.unlink()
+
+
+def concatenateChunks(chunkFiles: list[Path], outFile: Path):
+    # Every chunk is a complete HEVC elementary stream starting with its own
+    # parameter sets and an IDR frame, so they can simply be appended.
+    with open(outFile, "wb") as out:
+        for chunkFile in chunkFiles:
+            with open(chunkFile, "rb") as chunk:
+                shutil.copyfileobj(chunk, out, 16 * 1024 * 1024)
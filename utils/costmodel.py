@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# Rough estimate of how long converting a title takes, so the longest titles
+# can be started first and the whole batch gets an ETA before it starts.
+#
+# The video encode is what takes hours, so a title's estimate is the number
+# of frames of its source divided by the fps x265 gets with the title's
+# settings. That fps comes from earlier encodes with the same preset, CRF,
+# 2pass, and VapourSynth script (see 'recordEncode()'), kept in the cache
+# directory as pixels per second, so it carries over to other resolutions.
+# Settings that were never measured start from 'PRESET_FPS'.
+import heapq
+import os
+from pathlib import Path
+
+try:
+    import cache
+    import probecache
+    from info import Info
+except:
+    from utils import cache, probecache
+    from utils.info import Info
+
+# 1080p 10-bit fps of each x265 preset at its default CRF, on 8 threads.
+PRESET_FPS = {
+    "ultrafast": 60.0,
+    "superfast": 50.0,
+    "veryfast": 35.0,
+    "faster": 28.0,
+    "fast": 20.0,
+    "medium": 12.0,
+    "slow": 5.0,
+    "slower": 2.0,
+    "veryslow": 1.0,
+    "placebo": 0.4,
+}
+DEFAULT_PRESET = "medium"
+DEFAULT_CRF = 28.0
+REFERENCE_PIXELS = 1920 * 1080
+REFERENCE_THREADS = 8
+# Every CRF step below the default costs a few percent more time.
+CRF_STEP_COST = 0.03
+# The first pass is a little cheaper than the second.
+TWO_PASS_COST = 1.8
+# Filters of a script that was never measured.
+SCRIPT_COST = 1.25
+# Measurements that count for the average, older ones fade out.
+HISTORY_WEIGHT = 5
+
+
+def getOption(opts: list[str], name: str, default: str = "") -> str:
+    if name in opts and opts.index(name) + 1 < len(opts):
+        return opts[opts.index(name) + 1]
+    return default
+
+
+def profileKey(info: Info) -> str:
+    # Everything that changes x265's speed, except the resolution.
+    opts = info.videoInfo.x265Opts
+    script = ""
+    if info.videoInfo.vapoursynthScript:
+        scriptPath = info.getPath(info.videoInfo.vapoursynthScript)
+        try:
+            script = cache.hashKey(scriptPath.read_text())
+        except OSError:
+            script = info.videoInfo.vapoursynthScript
+    return cache.hashKey(
+        {
+            "preset": getOption(opts, "--preset", DEFAULT_PRESET),
+            "tune": getOption(opts, "--tune"),
+            "crf": getOption(opts, "--crf", str(DEFAULT_CRF)),
+            "twoPass": info.videoInfo.twoPass,
+            "script": script,
+            "cpus": os.cpu_count(),
+        }
+    )
+
+
+def sourceVideo(info: Info) -> tuple[int, int]:
+    # Frame count and pixels per frame of the source, (0, 0) when unknown.
+    probe = probecache.probe(str(info.getPath(info.sourceMKV)))
+    streams = [s for s in probe["streams"] if s.get("codec_type") == "video"]
+    if not streams:
+        return 0, 0
+    stream = streams[0]
+    pixels = int(stream.get("width", 0)) * int(stream.get("height", 0))
+
+    # mkvmerge writes the frame count into the track statistics tags.
+    for key, value in stream.get("tags", {}).items():
+        if key.upper().startswith("NUMBER_OF_FRAMES") and value.isdigit():
+            return int(value), pixels
+    if stream.get("nb_frames", "").isdigit():
+        return int(stream["nb_frames"]), pixels
+
+    numerator, _, denominator = stream.get("avg_frame_rate", "0/1").partition("/")
+    duration = float(probe["format"].get("duration", stream.get("duration", 0)))
+    if int(denominator or 1) == 0:
+        return 0, pixels
+    return round(duration * int(numerator) / int(denominator or 1)), pixels
+
+
+def defaultPixelRate(info: Info) -> float:
+    # Pixels per second of the whole machine for settings never measured.
+    opts = info.videoInfo.x265Opts
+    preset = getOption(opts, "--preset", DEFAULT_PRESET)
+    rate = PRESET_FPS.get(preset, PRESET_FPS[DEFAULT_PRESET]) * REFERENCE_PIXELS
+    rate *= (os.cpu_count() or 1) / REFERENCE_THREADS
+    try:
+        crf = float(getOption(opts, "--crf", str(DEFAULT_CRF)))
+    except ValueError:
+        crf = DEFAULT_CRF
+    rate /= max(0.5, 1 + CRF_STEP_COST * (DEFAULT_CRF - crf))
+    if info.videoInfo.twoPass:
+        rate /= TWO_PASS_COST
+    if info.videoInfo.vapoursynthScript:
+        rate /= SCRIPT_COST
+    return rate
+
+
+def estimate(info: Info, hostJobs: int = 1) -> float:
+    # Seconds the video of 'info' takes with 'hostJobs' titles sharing the
+    # machine, 0 when it isn't encoded.
+    if not info.videoInfo.convert:
+        return 0.0
+    frames, pixels = sourceVideo(info)
+    if not frames or not pixels:
+        return 0.0
+    history = cache.readCache("costmodel", profileKey(info))
+    rate = history["pixelRate"] if history else defaultPixelRate(info)
+    return frames * pixels * max(1, hostJobs) / rate
+
+
+def recordEncode(info: Info, seconds: float, hostJobs: int = 1):
+    # Called after a complete encode (both passes) of the whole source.
+    # 'seconds' only counts the x265 passes (with the VapourSynth filters
+    # feeding them), not the lossless cache, scene index, or HDR metadata.
+    # 'hostJobs' has to be the same as for 'estimate()'.
+    if seconds <= 0:
+        return
+    frames, pixels = sourceVideo(info)
+    if not frames or not pixels:
+        return
+    key = profileKey(info)
+    measured = frames * pixels * max(1, hostJobs) / seconds
+    history = cache.readCache("costmodel", key) or {"pixelRate": 0.0, "encodes": 0}
+    encodes = min(history["encodes"] + 1, HISTORY_WEIGHT)
+    history["pixelRate"] += (measured - history["pixelRate"]) / encodes
+    history["encodes"] += 1
+    cache.writeCache("costmodel", key, history)
+
+
+def formatDuration(seconds: float) -> str:
+    seconds = int(seconds)
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def batchTime(estimates: list[float], jobs: int) -> float:
+    # Every title starts on the first job slot that is free, in list order.
+    slots = [0.0] * max(1, min(jobs, len(estimates)))
+    for seconds in estimates:
+        heapq.heappush(slots, heapq.heappop(slots) + seconds)
+    return max(slots) if estimates else 0.0
+
+
+def schedule(folders: list[Path], infoFile: str, jobs: int = 1) -> list[Path]:
+    # 'folders' longest first, printing every estimate and the batch ETA.
+    hostJobs = max(1, min(jobs, len(folders)))
+    estimates = {}
+    for folder in folders:
+        try:
+            info = Info(str(folder.joinpath(infoFile)))
+            outputFilePath = info.getPath(info.outputFile).resolve()
+            if outputFilePath.parent.with_name(outputFilePath.name).exists():
+                estimates[folder] = 0.0
+            else:
+                estimates[folder] = estimate(info, hostJobs)
+        except Exception as e:
+            print("Can't estimate '{}': {}".format(folder.name, e))
+            estimates[folder] = 0.0
+
+    ordered = sorted(folders, key=lambda folder: estimates[folder], reverse=True)
+    print("Estimated encode times:")
+    for folder in ordered:
+        print("  {:>10} {}".format(formatDuration(estimates[folder]), folder.name))
+    print(
+        "Estimated time for {} folders with {} at a time: {}\n".format(
+            len(folders),
+            hostJobs,
+            formatDuration(batchTime([estimates[f] for f in ordered], hostJobs)),
+        )
+    )
+    return ordered
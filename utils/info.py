@@ -1,13 +1,16 @@
 #!/usr/bin/python3
 import json
 import copy
-import subprocess as sp
 from pathlib import Path
 from typing import Self
 
 try:
+    import matroska
+    import probecache
     import videoinfo
 except:
+    from utils import matroska
+    from utils import probecache
     from utils import videoinfo
 
 
@@ -70,8 +73,8 @@ class SubtitleTrackInfo(TrackInfo):
         if self.external:
             yield "external", self.external
 
-    def hasForcedFile(self):
-        return Path(self.getForcedFile()).exists()
+    def hasForcedFile(self, folder: Path = Path()):
+        return folder.joinpath(self.getForcedFile()).exists()
 
     def getForcedFile(self):
         return "forced-{}".format(self.getOutFile())
@@ -140,6 +143,10 @@ class AudioTrackInfo(TrackInfo):
         return result
 
 
+# Settings of the vapoursynth core that can be in the "vapoursynth" section.
+CORE_SETTINGS = ["threads", "cacheSize", "prefetch"]
+
+
 class VideoTrackInfo:
     def __init__(
         self,
@@ -152,7 +159,11 @@ class VideoTrackInfo:
         x265Opts: list[str] = [],
         vapoursynthScript: str = "",
         vapoursynthVars: dict = {},
+        vapoursynthCore: dict = {},
         mkvmergeOpts: list[str] = [],
+        chunked: dict = {},
+        losslessCache: bool = False,
+        resume: bool = False,
     ):
         self.title = title
         self.language = language
@@ -162,7 +173,15 @@ class VideoTrackInfo:
         self.x265Opts = x265Opts
         self.vapoursynthScript = vapoursynthScript
         self.vapoursynthVars = vapoursynthVars
+        # 'threads', 'cacheSize' (MB), and 'prefetch' (frames) of the vapoursynth core.
+        self.vapoursynthCore: dict = vapoursynthCore
         self.mkvmergeOpts: list[str] = mkvmergeOpts
+        # Encode in chunks with several x265 processes, e.g. {"workers": 4}
+        self.chunked: dict = chunked
+        # Render the vapoursynth output once to a lossless file, and encode from that.
+        self.losslessCache: bool = losslessCache
+        # Encode in segments, so an interrupted encode can continue where it stopped.
+        self.resume: bool = resume
 
         if jsonData:
             vapoursynth = False
@@ -185,8 +204,19 @@ class VideoTrackInfo:
                     self.vapoursynthScript = jsonData["vapoursynth"]["script"]
                 if "variables" in jsonData["vapoursynth"]:
                     self.vapoursynthVars = jsonData["vapoursynth"]["variables"]
+                self.vapoursynthCore = {
+                    key: jsonData["vapoursynth"][key]
+                    for key in CORE_SETTINGS
+                    if key in jsonData["vapoursynth"]
+                }
             if "mkvmergeOpts" in jsonData:
                 self.mkvmergeOpts = jsonData["mkvmergeOpts"]
+            if "chunked" in jsonData:
+                self.chunked = jsonData["chunked"]
+            if "losslessCache" in jsonData:
+                self.losslessCache = jsonData["losslessCache"]
+            if "resume" in jsonData:
+                self.resume = jsonData["resume"]
 
     def __iter__(self):
         vapoursynth = {}
@@ -195,6 +225,7 @@ class VideoTrackInfo:
         if vapoursynth:
             if self.vapoursynthVars != {}:
                 vapoursynth["variables"] = self.vapoursynthVars
+        vapoursynth.update(self.vapoursynthCore)
         yield "title", self.title
         yield "language", self.language
         yield "output", self.output
@@ -205,6 +236,12 @@ class VideoTrackInfo:
         yield "vapoursynth", vapoursynth
         if self.mkvmergeOpts != []:
             yield "mkvmergeOpts", self.mkvmergeOpts
+        if self.chunked:
+            yield "chunked", self.chunked
+        if self.losslessCache:
+            yield "losslessCache", self.losslessCache
+        if self.resume:
+            yield "resume", self.resume
 
 
 class Info:
@@ -223,11 +260,14 @@ class Info:
         self.title: str = title
         self.sourceMKV: str = outputFile
         self.outputFile: str = ""
+        # Folder that relative paths in the json file are resolved against.
+        self.folder: Path = Path.cwd()
         self.videoInfo: VideoTrackInfo
         self.audioInfo: list[AudioTrackInfo] = []
         self.subInfo: list[SubtitleTrackInfo] = []
         if jsonFile:
             jsonData: dict = json.loads(Path(jsonFile).read_text())
+            self.folder = Path(jsonFile).resolve().parent
             if "blurayPath" in jsonData:
                 self.blurayPath = jsonData["blurayPath"]
             if "blurayFile" in jsonData:
@@ -253,8 +293,19 @@ class Info:
                         self.videoInfo.vapoursynthScript = vapoursynth["script"]
                     if "variables" in vapoursynth:
                         self.videoInfo.vapoursynthVars = vapoursynth["variables"]
+                    self.videoInfo.vapoursynthCore = {
+                        key: vapoursynth[key]
+                        for key in CORE_SETTINGS
+                        if key in vapoursynth
+                    }
             if "mkvmergeOpts" in jsonData["video"]:
                 self.videoInfo.mkvmergeOpts = jsonData["video"]["mkvmergeOpts"]
+            if "chunked" in jsonData["video"]:
+                self.videoInfo.chunked = jsonData["video"]["chunked"]
+            if "losslessCache" in jsonData["video"]:
+                self.videoInfo.losslessCache = jsonData["video"]["losslessCache"]
+            if "resume" in jsonData["video"]:
+                self.videoInfo.resume = jsonData["video"]["resume"]
 
             if "audio" in jsonData:
                 for i in range(len(jsonData["audio"])):
@@ -340,6 +391,9 @@ class Info:
     def __str__(self):
         return json.dumps(dict(self), indent=2)
 
+    def getPath(self, fileName: str) -> Path:
+        return self.folder.joinpath(fileName)
+
     def generateTemplate(
         self,
         sourceMKV: str,
@@ -349,26 +403,13 @@ class Info:
         sup2srt: list[int] = [],
         srtFilter: list[int] = [],
     ):
-        ffprobeInfo = dict(
-            json.loads(
-                sp.check_output(
-                    (
-                        "ffprobe",
-                        "-v",
-                        "quiet",
-                        "-print_format",
-                        "json",
-                        "-show_format",
-                        "-show_streams",
-                        "-show_frames",
-                        "-read_intervals",
-                        "%+#20",
-                        sourceMKV,
-                    ),
-                    encoding="utf-8",
-                )
-            )
-        )
+        # Reading the Matroska headers is a lot faster than starting ffprobe.
+        try:
+            ffprobeInfo = matroska.probe(sourceMKV)
+        except matroska.MatroskaError:
+            ffprobeInfo = probecache.probe(sourceMKV)
+        else:
+            self.probeProfiles(ffprobeInfo, sourceMKV)
         self.sourceMKV = sourceMKV
         self.title = "Insert Title Here"
         if title:
@@ -436,7 +477,7 @@ class Info:
                 self.subInfo.append(template)
 
     def getVideoTemplate(self, ffInfo: dict, inFile: str) -> VideoTrackInfo:
-        videoInfo = videoinfo.videoInfo(inFile)
+        videoInfo = videoinfo.videoInfo(inFile, ffInfo)
         output = VideoTrackInfo()
 
         title = ["{}x{}p{}".format(videoInfo.Width, videoInfo.Height, videoInfo.FPS)]
@@ -484,6 +525,20 @@ class Info:
 
         return output
 
+    def probeProfiles(self, ffInfo: dict, sourceMKV: str):
+        # The headers don't tell DTS:X (and not always TrueHD Atmos) apart,
+        # so those streams get their profile from ffprobe.
+        undecided = [s for s in ffInfo["streams"] if matroska.profileUndecided(s)]
+        if not undecided:
+            return
+        probed = probecache.probe(sourceMKV)["streams"]
+        for stream in undecided:
+            if stream["index"] >= len(probed):
+                continue
+            stream.pop("profile", None)
+            if "profile" in probed[stream["index"]]:
+                stream["profile"] = probed[stream["index"]]["profile"]
+
     def getAudioTemplate(self, ffInfo: dict, trackid: int) -> AudioTrackInfo | None:
         if ffInfo["streams"][trackid]["codec_type"] not in "audio":
             return None
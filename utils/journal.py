@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Journal of the work that was done in a title's folder.
+#
+# Every entry records what a piece of work (extracting a track, converting
+# an audio track, the video encode, ...) read, the settings it used, and the
+# files it wrote. The work only counts as done when all of those are still
+# the same, so a half written file of a crashed run, a changed source, or an
+# edited info.json make it run again.
+import json
+import os
+import threading
+from pathlib import Path
+
+try:
+    import cache
+except:
+    from utils import cache
+
+JOURNAL_FILE = "stage-journal.json"
+
+_journals: dict[Path, "StageJournal"] = {}
+_journalsLock = threading.Lock()
+
+
+def getJournal(folder: Path) -> "StageJournal":
+    # Stages running in different threads have to share one journal per folder.
+    folder = Path(folder).resolve()
+    with _journalsLock:
+        if folder not in _journals:
+            _journals[folder] = StageJournal(folder)
+        return _journals[folder]
+
+
+class StageJournal:
+    def __init__(self, folder: Path, fileName: str = JOURNAL_FILE):
+        self.folder: Path = Path(folder)
+        self.path: Path = self.folder.joinpath(fileName)
+        self.lock = threading.RLock()
+        self.entries: dict[str, dict] = {}
+        try:
+            self.entries = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def fingerprint(self, fileName) -> dict | None:
+        path = self.folder.joinpath(fileName)
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    def fingerprints(self, fileNames: list) -> dict:
+        return {str(f): self.fingerprint(f) for f in fileNames}
+
+    def outputs(self, name: str) -> list[str]:
+        # Files recorded by the last run, for work that doesn't always write
+        # the same files.
+        with self.lock:
+            return list(self.entries.get(name, {}).get("outputs", {}))
+
+    def hasEntry(self, name: str) -> bool:
+        with self.lock:
+            return name in self.entries
+
+    def isDone(self, name: str, inputs: list = [], params=None, outputs: list = []):
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is None or entry["status"] != "done":
+            return False
+        if entry["params"] != cache.hashKey(params):
+            return False
+        if entry["inputs"] != self.fingerprints(inputs):
+            return False
+        currentOutputs = self.fingerprints(outputs)
+        if None in currentOutputs.values():
+            return False
+        return entry["outputs"] == currentOutputs
+
+    def start(self, name: str):
+        with self.lock:
+            entry = self.entries.setdefault(name, {})
+            entry["status"] = "running"
+            self.save()
+
+    def finish(self, name: str, inputs: list = [], params=None, outputs: list = []):
+        with self.lock:
+            self.entries[name] = {
+                "status": "done",
+                "inputs": self.fingerprints(inputs),
+                "params": cache.hashKey(params),
+                "outputs": self.fingerprints(outputs),
+            }
+            self.save()
+
+    def refreshOutputs(self, name: str):
+        # For work that changes the output of an earlier step in place
+        # (like clearing the forced flags of a subtitle track).
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None or entry["status"] != "done":
+                return
+            entry["outputs"] = self.fingerprints(list(entry["outputs"]))
+            self.save()
+
+    def save(self):
+        tempPath = self.path.with_name(
+            "{}.{}.{}.tmp".format(self.path.name, os.getpid(), threading.get_ident())
+        )
+        tempPath.write_text(json.dumps(self.entries, indent=2))
+        tempPath.replace(self.path)
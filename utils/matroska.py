@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+# Reads the track list of a Matroska file without starting ffprobe.
+#
+# Only the EBML element headers up to the first Cluster, the Segment Info,
+# the Tracks, and the first block of each track are read, so even a 80GB
+# remux only costs a few pages of I/O.
+#
+# 'probe()' returns the parts of ffprobe's json output that the info.json
+# templates use ("format", "streams", and "frames" with the HDR side data).
+# Things that ffprobe finds by decoding are only partly covered:
+# DTS-HD and HDR10+ are found by peeking at the first block of a track,
+# TrueHD Atmos is guessed from the number of substreams, and DTS:X
+# isn't detected at all. 'profileUndecided()' tells which audio streams
+# need ffprobe for their profile.
+import math
+import mmap
+import struct
+from fractions import Fraction
+
+# Element IDs (with the length marker, like they're written in the spec).
+EBML = 0x1A45DFA3
+DOCTYPE = 0x4282
+SEGMENT = 0x18538067
+SEEKHEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEKID = 0x53AB
+SEEKPOSITION = 0x53AC
+INFO = 0x1549A966
+TITLE = 0x7BA9
+TRACKS = 0x1654AE6B
+CLUSTER = 0x1F43B675
+SIMPLEBLOCK = 0xA3
+BLOCKGROUP = 0xA0
+BLOCK = 0xA1
+TRACKENTRY = 0xAE
+TRACKNUMBER = 0xD7
+TRACKTYPE = 0x83
+CODECID = 0x86
+LANGUAGE = 0x22B59C
+NAME = 0x536E
+FLAGDEFAULT = 0x88
+FLAGFORCED = 0x55AA
+DEFAULTDURATION = 0x23E383
+VIDEO = 0xE0
+PIXELWIDTH = 0xB0
+PIXELHEIGHT = 0xBA
+DISPLAYWIDTH = 0x54B0
+DISPLAYHEIGHT = 0x54BA
+DISPLAYUNIT = 0x54B2
+COLOUR = 0x55B0
+MATRIXCOEFFICIENTS = 0x55B1
+RANGE = 0x55B9
+TRANSFERCHARACTERISTICS = 0x55BA
+PRIMARIES = 0x55BB
+MAXCLL = 0x55BC
+MAXFALL = 0x55BD
+MASTERINGMETADATA = 0x55D0
+AUDIO = 0xE1
+SAMPLINGFREQUENCY = 0xB5
+CHANNELS = 0x9F
+BITDEPTH = 0x6264
+BLOCKADDITIONMAPPING = 0x41E4
+BLOCKADDIDTYPE = 0x41E7
+CONTENTENCODINGS = 0x6D80
+CONTENTENCODING = 0x6240
+CONTENTCOMPRESSION = 0x5034
+CONTENTCOMPALGO = 0x4254
+CONTENTCOMPSETTINGS = 0x4255
+
+MASTERING_FIELDS = {
+    0x55D1: ("red_x", 50000),
+    0x55D2: ("red_y", 50000),
+    0x55D3: ("green_x", 50000),
+    0x55D4: ("green_y", 50000),
+    0x55D5: ("blue_x", 50000),
+    0x55D6: ("blue_y", 50000),
+    0x55D7: ("white_point_x", 50000),
+    0x55D8: ("white_point_y", 50000),
+    0x55D9: ("max_luminance", 10000),
+    0x55DA: ("min_luminance", 10000),
+}
+
+TRACK_TYPES = {1: "video", 2: "audio", 17: "subtitle"}
+
+# Codec IDs to ffprobe's 'codec_name', the first matching prefix wins.
+CODECS = [
+    ("V_MPEGH/ISO/HEVC", "hevc"),
+    ("V_MPEG4/ISO/AVC", "h264"),
+    ("V_MPEG2", "mpeg2video"),
+    ("V_MPEG1", "mpeg1video"),
+    ("V_AV1", "av1"),
+    ("V_VP9", "vp9"),
+    ("V_MS/VFW/FOURCC", "vc1"),
+    ("A_TRUEHD", "truehd"),
+    ("A_DTS", "dts"),
+    ("A_EAC3", "eac3"),
+    ("A_AC3", "ac3"),
+    ("A_AAC", "aac"),
+    ("A_FLAC", "flac"),
+    ("A_OPUS", "opus"),
+    ("A_VORBIS", "vorbis"),
+    ("A_MPEG/L3", "mp3"),
+    ("A_MPEG/L2", "mp2"),
+    ("A_PCM/FLOAT/IEEE", "pcm_f{}le"),
+    ("A_PCM/INT/BIG", "pcm_s{}be"),
+    ("A_PCM/INT/LIT", "pcm_s{}le"),
+    ("S_HDMV/PGS", "hdmv_pgs_subtitle"),
+    ("S_HDMV/TEXTST", "hdmv_text_subtitle"),
+    ("S_TEXT/UTF8", "subrip"),
+    ("S_TEXT/ASS", "ass"),
+    ("S_TEXT/SSA", "ssa"),
+    ("S_VOBSUB", "dvd_subtitle"),
+]
+
+MATRICES = {
+    0: "gbr",
+    1: "bt709",
+    5: "bt470bg",
+    6: "smpte170m",
+    9: "bt2020nc",
+    10: "bt2020c",
+}
+TRANSFERS = {
+    1: "bt709",
+    6: "smpte170m",
+    14: "bt2020-10",
+    15: "bt2020-12",
+    16: "smpte2084",
+    18: "arib-std-b67",
+}
+PRIMARIES_NAMES = {
+    1: "bt709",
+    5: "bt470bg",
+    6: "smpte170m",
+    9: "bt2020",
+    11: "smpte431",
+    12: "smpte432",
+}
+CHANNEL_LAYOUTS = {1: "mono", 2: "stereo", 6: "5.1(side)", 7: "6.1", 8: "7.1"}
+
+# Dolby Vision configuration boxes in 'BlockAdditionMapping'.
+DOVI_TYPES = [int.from_bytes(b"dvcC", "big"), int.from_bytes(b"dvvC", "big")]
+# ITU-T T.35 header of HDR10+ SEI messages (country, provider, oriented, app).
+HDR10PLUS_SEI = b"\xb5\x00\x3c\x00\x01\x04"
+DTSHD_SYNC = b"\x64\x58\x20\x25"
+DTSHD_XLL_SYNC = b"\x41\xa2\x95\x47"
+TRUEHD_SYNC = b"\xf8\x72\x6f\xba"
+
+# Bytes of Clusters read while looking for the first block of every track.
+PEEK_LIMIT = 32 * 1024 * 1024
+# Bytes kept of each first block.
+PEEK_BYTES = 64 * 1024
+
+
+class MatroskaError(Exception):
+    pass
+
+
+def readVint(data, pos: int) -> tuple[int, int]:
+    # Returns (value, length), the length marker is removed.
+    first = data[pos]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        length += 1
+        mask >>= 1
+    if length > 8:
+        raise MatroskaError("Invalid EBML number at {}".format(pos))
+    value = first & (mask - 1)
+    for b in data[pos + 1 : pos + length]:
+        value = (value << 8) | b
+    # All ones means 'unknown size'.
+    if value == (1 << (7 * length)) - 1:
+        value = -1
+    return value, length
+
+
+def readId(data, pos: int) -> tuple[int, int]:
+    # IDs keep their length marker.
+    first = data[pos]
+    length = 1
+    mask = 0x80
+    while length <= 4 and not first & mask:
+        length += 1
+        mask >>= 1
+    if length > 4:
+        raise MatroskaError("Invalid EBML ID at {}".format(pos))
+    return int.from_bytes(data[pos : pos + length], "big"), length
+
+
+def iterElements(data, start: int, end: int):
+    # Yields (id, data start, data end) of the elements between 'start' and 'end'.
+    pos = start
+    while pos < end:
+        elementId, idLength = readId(data, pos)
+        size, sizeLength = readVint(data, pos + idLength)
+        dataStart = pos + idLength + sizeLength
+        dataEnd = end if size < 0 else min(end, dataStart + size)
+        yield elementId, dataStart, dataEnd
+        pos = dataEnd
+
+
+def readUInt(data, start: int, end: int) -> int:
+    return int.from_bytes(data[start:end], "big")
+
+
+def readFloat(data, start: int, end: int) -> float:
+    if end - start == 4:
+        return struct.unpack(">f", data[start:end])[0]
+    if end - start == 8:
+        return struct.unpack(">d", data[start:end])[0]
+    return 0.0
+
+
+def readString(data, start: int, end: int) -> str:
+    return bytes(data[start:end]).split(b"\0", 1)[0].decode("utf-8", "replace")
+
+
+def parseTrack(data, start: int, end: int) -> dict:
+    track = {
+        "number": 0,
+        "type": 0,
+        "codecId": "",
+        "language": "eng",
+        "name": "",
+        "default": True,
+        "forced": False,
+        "defaultDuration": 0,
+        "video": {},
+        "colour": {},
+        "mastering": {},
+        "audio": {},
+        "doviConfig": False,
+        "strippedHeader": b"",
+    }
+    for elementId, s, e in iterElements(data, start, end):
+        if elementId == TRACKNUMBER:
+            track["number"] = readUInt(data, s, e)
+        elif elementId == TRACKTYPE:
+            track["type"] = readUInt(data, s, e)
+        elif elementId == CODECID:
+            track["codecId"] = readString(data, s, e)
+        elif elementId == LANGUAGE:
+            track["language"] = readString(data, s, e)
+        elif elementId == NAME:
+            track["name"] = readString(data, s, e)
+        elif elementId == FLAGDEFAULT:
+            track["default"] = bool(readUInt(data, s, e))
+        elif elementId == FLAGFORCED:
+            track["forced"] = bool(readUInt(data, s, e))
+        elif elementId == DEFAULTDURATION:
+            track["defaultDuration"] = readUInt(data, s, e)
+        elif elementId == VIDEO:
+            parseVideo(data, s, e, track)
+        elif elementId == AUDIO:
+            for audioId, s2, e2 in iterElements(data, s, e):
+                if audioId == SAMPLINGFREQUENCY:
+                    track["audio"]["sampleRate"] = readFloat(data, s2, e2)
+                elif audioId == CHANNELS:
+                    track["audio"]["channels"] = readUInt(data, s2, e2)
+                elif audioId == BITDEPTH:
+                    track["audio"]["bitDepth"] = readUInt(data, s2, e2)
+        elif elementId == BLOCKADDITIONMAPPING:
+            for mappingId, s2, e2 in iterElements(data, s, e):
+                if mappingId == BLOCKADDIDTYPE:
+                    if readUInt(data, s2, e2) in DOVI_TYPES:
+                        track["doviConfig"] = True
+        elif elementId == CONTENTENCODINGS:
+            track["strippedHeader"] = parseHeaderStripping(data, s, e)
+    return track
+
+
+def parseVideo(data, start: int, end: int, track: dict):
+    video = track["video"]
+    for elementId, s, e in iterElements(data, start, end):
+        if elementId == PIXELWIDTH:
+            video["width"] = readUInt(data, s, e)
+        elif elementId == PIXELHEIGHT:
+            video["height"] = readUInt(data, s, e)
+        elif elementId == DISPLAYWIDTH:
+            video["displayWidth"] = readUInt(data, s, e)
+        elif elementId == DISPLAYHEIGHT:
+            video["displayHeight"] = readUInt(data, s, e)
+        elif elementId == DISPLAYUNIT:
+            video["displayUnit"] = readUInt(data, s, e)
+        elif elementId == COLOUR:
+            for colourId, s2, e2 in iterElements(data, s, e):
+                if colourId == MASTERINGMETADATA:
+                    for masteringId, s3, e3 in iterElements(data, s2, e2):
+                        if masteringId in MASTERING_FIELDS:
+                            value = readFloat(data, s3, e3)
+                            track["mastering"][masteringId] = value
+                elif colourId in [MAXCLL, MAXFALL, RANGE, MATRIXCOEFFICIENTS]:
+                    track["colour"][colourId] = readUInt(data, s2, e2)
+                elif colourId in [TRANSFERCHARACTERISTICS, PRIMARIES]:
+                    track["colour"][colourId] = readUInt(data, s2, e2)
+
+
+def parseHeaderStripping(data, start: int, end: int) -> bytes:
+    # mkvmerge used to strip the common start of every frame ('header removal
+    # compression'), it has to be put back before looking at a block.
+    for encodingId, s, e in iterElements(data, start, end):
+        if encodingId != CONTENTENCODING:
+            continue
+        for encId, s2, e2 in iterElements(data, s, e):
+            if encId != CONTENTCOMPRESSION:
+                continue
+            algo = 0
+            settings = b""
+            for compId, s3, e3 in iterElements(data, s2, e2):
+                if compId == CONTENTCOMPALGO:
+                    algo = readUInt(data, s3, e3)
+                elif compId == CONTENTCOMPSETTINGS:
+                    settings = bytes(data[s3:e3])
+            if algo == 3:
+                return settings
+    return b""
+
+
+def peekBlocks(data, clusterPos: int, end: int, trackNumbers: set) -> dict:
+    # First block of each track in 'trackNumbers', by track number.
+    blocks: dict[int, bytes] = {}
+    limit = min(end, clusterPos + PEEK_LIMIT)
+    for elementId, s, e in iterElements(data, clusterPos, end):
+        if s >= limit or len(blocks) == len(trackNumbers):
+            break
+        if elementId != CLUSTER:
+            continue
+        for childId, s2, e2 in iterElements(data, s, min(e, limit)):
+            if childId == BLOCKGROUP:
+                for blockId, s3, e3 in iterElements(data, s2, e2):
+                    if blockId == BLOCK:
+                        s2, e2 = s3, e3
+                        childId = SIMPLEBLOCK
+            if childId != SIMPLEBLOCK:
+                continue
+            trackNumber, length = readVint(data, s2)
+            if trackNumber in trackNumbers and trackNumber not in blocks:
+                # Track number, 16bit timecode, and flags.
+                blockStart = s2 + length + 3
+                blocks[trackNumber] = bytes(
+                    data[blockStart : min(e2, blockStart + PEEK_BYTES)]
+                )
+            if len(blocks) == len(trackNumbers):
+                break
+    return blocks
+
+
+def readFile(data) -> tuple[str, list[dict], dict]:
+    # Returns (title, tracks, first block of each video and audio track).
+    if len(data) < 4 or readId(data, 0)[0] != EBML:
+        raise MatroskaError("Not an EBML file.")
+    elementId, s, e = next(iterElements(data, 0, len(data)))
+    for headerId, s2, e2 in iterElements(data, s, e):
+        if headerId == DOCTYPE:
+            if readString(data, s2, e2) not in ["matroska", "webm"]:
+                raise MatroskaError("Not a Matroska file.")
+
+    segmentId, idLength = readId(data, e)
+    if segmentId != SEGMENT:
+        raise MatroskaError("No Segment after the EBML header.")
+    size, sizeLength = readVint(data, e + idLength)
+    segmentStart = e + idLength + sizeLength
+    segmentEnd = len(data) if size < 0 else min(len(data), segmentStart + size)
+
+    # Info and Tracks are normally in front of the first Cluster,
+    # the SeekHead tells where they are when they aren't.
+    ranges: dict[int, tuple[int, int]] = {}
+    seekPositions: dict[int, int] = {}
+    clusterPos = None
+    elementPos = segmentStart
+    for elementId, s, e in iterElements(data, segmentStart, segmentEnd):
+        if elementId == SEEKHEAD:
+            for seekId, s2, e2 in iterElements(data, s, e):
+                if seekId == SEEK:
+                    target, position = readSeek(data, s2, e2)
+                    if target is not None and position is not None:
+                        seekPositions.setdefault(target, segmentStart + position)
+        elif elementId in [INFO, TRACKS]:
+            ranges.setdefault(elementId, (s, e))
+        elif elementId == CLUSTER:
+            clusterPos = elementPos
+            break
+        elementPos = e
+
+    for target in [INFO, TRACKS]:
+        if target in ranges or seekPositions.get(target, segmentEnd) >= segmentEnd:
+            continue
+        elementId, s, e = next(iterElements(data, seekPositions[target], segmentEnd))
+        if elementId == target:
+            ranges[target] = (s, e)
+
+    if TRACKS not in ranges:
+        raise MatroskaError("No Tracks element found.")
+
+    title = ""
+    if INFO in ranges:
+        for elementId, s, e in iterElements(data, *ranges[INFO]):
+            if elementId == TITLE:
+                title = readString(data, s, e)
+
+    tracks = []
+    for elementId, s, e in iterElements(data, *ranges[TRACKS]):
+        if elementId == TRACKENTRY:
+            tracks.append(parseTrack(data, s, e))
+
+    blocks = {}
+    if clusterPos is not None:
+        wanted = {t["number"] for t in tracks if t["type"] in [1, 2]}
+        blocks = peekBlocks(data, clusterPos, segmentEnd, wanted)
+        for track in tracks:
+            if track["number"] in blocks and track["strippedHeader"]:
+                blocks[track["number"]] = (
+                    track["strippedHeader"] + blocks[track["number"]]
+                )
+    return title, tracks, blocks
+
+
+def readSeek(data, start: int, end: int) -> tuple[int | None, int | None]:
+    target = None
+    position = None
+    for elementId, s, e in iterElements(data, start, end):
+        if elementId == SEEKID:
+            target = readUInt(data, s, e)
+        elif elementId == SEEKPOSITION:
+            position = readUInt(data, s, e)
+    return target, position
+
+
+def fraction(value: float, denominator: int) -> str:
+    # ffprobe prints mastering display values as fractions.
+    return "{}/{}".format(round(value * denominator), denominator)
+
+
+def getStream(index: int, track: dict, block: bytes) -> tuple[dict, list]:
+    # Returns the stream like ffprobe shows it, and the side data ffprobe
+    # would show for its first frame.
+    codecType = TRACK_TYPES.get(track["type"], "data")
+    codecName = track["codecId"].lower()
+    for prefix, name in CODECS:
+        if track["codecId"].startswith(prefix):
+            codecName = name.format(track["audio"].get("bitDepth", 16))
+            break
+
+    stream = {
+        "index": index,
+        "codec_name": codecName,
+        "codec_type": codecType,
+        "disposition": {
+            "default": int(track["default"]),
+            "forced": int(track["forced"]),
+        },
+        "tags": {"language": track["language"]},
+    }
+    if track["name"]:
+        stream["tags"]["title"] = track["name"]
+    sideData = []
+
+    if codecType == "video":
+        video = track["video"]
+        width = video.get("width", 0)
+        height = video.get("height", 0)
+        stream["width"] = width
+        stream["height"] = height
+        if track["defaultDuration"]:
+            rate = Fraction(1000000000, track["defaultDuration"]).limit_denominator(
+                1001
+            )
+            stream["r_frame_rate"] = "{}/{}".format(rate.numerator, rate.denominator)
+            stream["avg_frame_rate"] = stream["r_frame_rate"]
+
+        displayWidth = video.get("displayWidth", width)
+        displayHeight = video.get("displayHeight", height)
+        if video.get("displayUnit", 0) == 0 and displayWidth and displayHeight:
+            divisor = math.gcd(displayWidth, displayHeight)
+            stream["display_aspect_ratio"] = "{}:{}".format(
+                displayWidth // divisor, displayHeight // divisor
+            )
+
+        colour = track["colour"]
+        if colour.get(RANGE) in [1, 2]:
+            stream["color_range"] = {1: "tv", 2: "pc"}[colour[RANGE]]
+        if colour.get(MATRIXCOEFFICIENTS) in MATRICES:
+            stream["color_space"] = MATRICES[colour[MATRIXCOEFFICIENTS]]
+        if colour.get(TRANSFERCHARACTERISTICS) in TRANSFERS:
+            stream["color_transfer"] = TRANSFERS[colour[TRANSFERCHARACTERISTICS]]
+        if colour.get(PRIMARIES) in PRIMARIES_NAMES:
+            stream["color_primaries"] = PRIMARIES_NAMES[colour[PRIMARIES]]
+
+        if track["mastering"]:
+            mastering = {"side_data_type": "Mastering display metadata"}
+            for elementId, value in track["mastering"].items():
+                name, denominator = MASTERING_FIELDS[elementId]
+                mastering[name] = fraction(value, denominator)
+            sideData.append(mastering)
+        if MAXCLL in colour or MAXFALL in colour:
+            sideData.append(
+                {
+                    "side_data_type": "Content light level metadata",
+                    "max_content": colour.get(MAXCLL, 0),
+                    "max_average": colour.get(MAXFALL, 0),
+                }
+            )
+        if track["doviConfig"]:
+            sideData.append({"side_data_type": "Dolby Vision Metadata"})
+        if HDR10PLUS_SEI in block:
+            sideData.append(
+                {"side_data_type": "HDR Dynamic Metadata SMPTE2094-40 (HDR10+)"}
+            )
+
+    elif codecType == "audio":
+        audio = track["audio"]
+        channels = audio.get("channels", 1)
+        stream["channels"] = channels
+        if channels in CHANNEL_LAYOUTS:
+            stream["channel_layout"] = CHANNEL_LAYOUTS[channels]
+        if "sampleRate" in audio:
+            stream["sample_rate"] = str(int(audio["sampleRate"]))
+
+        if codecName == "dts" and DTSHD_SYNC in block:
+            stream["profile"] = "DTS-HD HRA"
+            if DTSHD_XLL_SYNC in block:
+                stream["profile"] = "DTS-HD MA"
+        elif codecName == "truehd":
+            sync = block.find(TRUEHD_SYNC)
+            # 4 substreams means there's a 16 channel presentation.
+            if 0 <= sync and sync + 16 < len(block):
+                if block[sync + 8 : sync + 10] == b"\xb7\x52":
+                    if block[sync + 16] >> 4 == 4:
+                        stream["profile"] = "Dolby TrueHD + Dolby Atmos"
+
+    return stream, sideData
+
+
+def profileUndecided(stream: dict) -> bool:
+    # DTS:X is an extension of DTS-HD MA that's only found by decoding, and a
+    # TrueHD track without Atmos might just not start with a major sync.
+    if stream.get("codec_name") == "dts":
+        return stream.get("profile") != "DTS-HD HRA"
+    if stream.get("codec_name") == "truehd":
+        return "profile" not in stream
+    return False
+
+
+def probe(inFile: str) -> dict:
+    try:
+        with open(inFile, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                title, tracks, blocks = readFile(data)
+    except (IndexError, StopIteration, ValueError, struct.error) as e:
+        # Empty or cut off files.
+        raise MatroskaError("Can't read '{}': {!r}".format(inFile, e))
+
+    result = {"format": {"format_name": "matroska,webm"}, "streams": [], "frames": []}
+    if title:
+        result["format"]["tags"] = {"title": title}
+    for index, track in enumerate(tracks):
+        stream, sideData = getStream(index, track, blocks.get(track["number"], b""))
+        result["streams"].append(stream)
+        if sideData:
+            result["frames"].append({"stream_index": index, "side_data_list": sideData})
+    return result
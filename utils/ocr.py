@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# OCR of PGS subtitles with sup2srt, spread over several processes.
+#
+# sup2srt reads the whole '.sup' on one core. The track is cut into one part
+# per worker at epoch starts (see 'pgs.writeShards()'), every part is OCRed by
+# its own sup2srt, and the SRTs of the parts are merged into one, sorted by
+# time and numbered again. Every worker gets a single part, so the language
+# models are only loaded once per worker.
+#
+# The SRT is kept in the cache directory by the hash of the '.sup' and the
+# language, so SRT tracks made from the same PGS track (like the plain and
+# the filtered one) and later runs only OCR it once.
+import hashlib
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    import cache
+    import pgs
+    import progress
+    import resources
+    from stages import popen
+except:
+    from utils import cache, pgs, progress, resources
+    from utils.stages import popen
+
+# Captions a part should at least have, starting sup2srt has its own cost.
+MIN_SHARD_CAPTIONS = 100
+SRT_TIME = re.compile(r"^(\d+):(\d+):(\d+)[,.](\d+)\s*-->")
+_keyLocks: dict[str, threading.Lock] = {}
+_keyLocksLock = threading.Lock()
+
+
+def runSup2Srt(supFile: Path, outFile: Path, language: str, stage: str):
+    cmd = ["sup2srt", "-l", language, "-o", str(outFile), str(supFile)]
+    print(" ".join(cmd))
+    process = popen(cmd, cwd=outFile.parent)
+    if progress.run(process, None, stage, "sup2srt") != 0:
+        raise RuntimeError("sup2srt failed on '{}'.".format(supFile.name))
+
+
+def readSrt(srtFile: Path) -> list[tuple[int, str, str]]:
+    # (start in ms, time line, text) of every entry.
+    entries = []
+    text = Path(srtFile).read_text(encoding="utf-8-sig", errors="replace")
+    for block in re.split(r"\n\s*\n", text.replace("\r\n", "\n")):
+        lines = block.strip("\n").split("\n")
+        # The number in front of the time line isn't needed.
+        if len(lines) > 1 and SRT_TIME.match(lines[1]):
+            lines = lines[1:]
+        match = SRT_TIME.match(lines[0])
+        if not match:
+            continue
+        hours, minutes, seconds, ms = (int(x) for x in match.groups())
+        start = ((hours * 60 + minutes) * 60 + seconds) * 1000 + ms
+        entries.append((start, lines[0], "\n".join(lines[1:])))
+    return entries
+
+
+def mergeSrt(srtFiles: list[Path], outFile: Path):
+    entries = [entry for srtFile in srtFiles for entry in readSrt(srtFile)]
+    # Stable, entries at the same time keep their order.
+    entries.sort(key=lambda entry: entry[0])
+    blocks = [
+        "{}\n{}\n{}\n".format(i + 1, timeLine, text)
+        for i, (_, timeLine, text) in enumerate(entries)
+    ]
+    Path(outFile).write_text("\n".join(blocks), encoding="utf-8")
+
+
+def ocrKey(supFile: Path, language: str) -> str:
+    # By content, the '.sup' of another title with the same subtitles counts too.
+    digest = hashlib.sha256()
+    with open(supFile, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return cache.hashKey({"sup": digest.hexdigest(), "language": language})
+
+
+def ocr(
+    supFile: Path,
+    outFile: Path,
+    language: str,
+    scratchDir: Path,
+    jobs: int = 1,
+    stage: str = "",
+):
+    key = ocrKey(supFile, language)
+    with _keyLocksLock:
+        keyLock = _keyLocks.setdefault(key, threading.Lock())
+
+    # Tracks of the same '.sup' wait for the first one to OCR it.
+    with keyLock:
+        srt = cache.readCache("ocr", key)
+        if srt is not None:
+            print("Using the cached OCR of '{}'.".format(Path(supFile).name))
+            Path(outFile).write_text(srt, encoding="utf-8")
+            return
+        ocrParts(supFile, outFile, language, scratchDir, jobs, stage)
+        srt = Path(outFile).read_text(encoding="utf-8", errors="replace")
+        cache.writeCache("ocr", key, srt)
+
+
+def ocrParts(
+    supFile: Path,
+    outFile: Path,
+    language: str,
+    scratchDir: Path,
+    jobs: int = 1,
+    stage: str = "",
+):
+    # 'outFile' is written by sup2srt directly when there is only one part.
+    captions = pgs.countCaptions(supFile)
+    shards = max(1, min(jobs, captions // MIN_SHARD_CAPTIONS))
+    if shards == 1:
+        runSup2Srt(supFile, outFile, language, stage)
+        return
+
+    shardFiles = [
+        scratchDir.joinpath("shard-{:03d}.sup".format(i)) for i in range(shards)
+    ]
+    supFiles = pgs.writeShards(supFile, shardFiles)
+    srtFiles = [shardFile.with_suffix(".srt") for shardFile in supFiles]
+    print(
+        "OCR of {} captions in {} parts at the same time.".format(
+            captions, len(supFiles)
+        )
+    )
+    with ThreadPoolExecutor(
+        max_workers=len(supFiles),
+        initializer=resources.setStage,
+        initargs=(resources.currentStage(),),
+    ) as executor:
+        futures = [
+            executor.submit(
+                runSup2Srt,
+                shardFile,
+                srtFile,
+                language,
+                "{}:{}".format(stage, shardFile.stem),
+            )
+            for shardFile, srtFile in zip(supFiles, srtFiles)
+        ]
+        for future in futures:
+            future.result()
+    mergeSrt(srtFiles, outFile)
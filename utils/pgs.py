@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# Reading and writing PGS ('.sup') subtitles, just enough to split off the
+# forced captions, or cut a track into parts for OCR, without decoding or
+# re-encoding any images.
+#
+# A '.sup' file is a list of segments, each with a 13 byte header ('PG', pts,
+# dts, type, size). The segments up to an END segment are a display set, which
+# starts with a presentation composition segment (PCS) listing the objects on
+# screen, each with its own forced flag. Display sets can use the windows
+# (WDS), palettes (PDS), and objects (ODS) of earlier display sets of the same
+# epoch, so a caption written without the ones in front of it gets copies of
+# those definitions, and becomes the start of a new epoch.
+#
+# The file is memory-mapped, segments that don't change are written straight
+# from the map.
+import mmap
+import struct
+from pathlib import Path
+
+PDS = 0x14
+ODS = 0x15
+PCS = 0x16
+WDS = 0x17
+END = 0x80
+HEADER = struct.Struct(">2sIIBH")
+MAGIC = b"PG"
+# 'composition_state' of a PCS, and its offset.
+EPOCH_START = 0x80
+STATE_OFFSET = 7
+PALETTE_UPDATE_OFFSET = 8
+PALETTE_ID_OFFSET = 9
+OBJECTS_OFFSET = 10
+# Flags of a composition object.
+CROPPED_FLAG = 0x80
+FORCED_FLAG = 0x40
+# 'first_in_sequence' bit of an ODS's sequence flags, objects can be split
+# over several ODS.
+FIRST_IN_SEQUENCE = 0x80
+
+
+class Segment:
+    def __init__(self, data, offset: int):
+        _, self.pts, self.dts, self.type, size = HEADER.unpack_from(data, offset)
+        self.data = data[offset : offset + HEADER.size + size]
+
+    @property
+    def payload(self):
+        return self.data[HEADER.size :]
+
+    def retimed(self, pts: int, dts: int) -> bytes:
+        # A copy of the segment at another time.
+        header = HEADER.pack(MAGIC, pts, dts, self.type, len(self.payload))
+        return header + bytes(self.payload)
+
+
+def readSegments(data) -> list[Segment]:
+    segments = []
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        if data[offset : offset + 2] != MAGIC:
+            raise ValueError("Not a PGS segment at byte {}.".format(offset))
+        segment = Segment(data, offset)
+        segments.append(segment)
+        offset += len(segment.data)
+    return segments
+
+
+def displaySets(segments: list[Segment]) -> list[list[Segment]]:
+    result = []
+    current: list[Segment] = []
+    for segment in segments:
+        current.append(segment)
+        if segment.type == END:
+            result.append(current)
+            current = []
+    if current:
+        result.append(current)
+    return result
+
+
+def compositionObjects(pcs) -> list[tuple[int, int, int]]:
+    # (offset of the flags in the payload, object id, flags) of every object.
+    objects = []
+    offset = OBJECTS_OFFSET + 1
+    for _ in range(pcs[OBJECTS_OFFSET]):
+        objectId, _, flags = struct.unpack_from(">HBB", pcs, offset)
+        objects.append((offset + 3, objectId, flags))
+        offset += 16 if flags & CROPPED_FLAG else 8
+    return objects
+
+
+def isForced(pcs) -> bool:
+    return any(flags & FORCED_FLAG for _, _, flags in compositionObjects(pcs))
+
+
+class EpochState:
+    # Windows, palettes, and objects defined so far in the current epoch.
+    def __init__(self):
+        self.window: Segment | None = None
+        self.palettes: dict[int, Segment] = {}
+        self.objects: dict[int, list[Segment]] = {}
+
+    def update(self, displaySet: list[Segment]):
+        pcs = displaySet[0].payload
+        if pcs[STATE_OFFSET] & EPOCH_START:
+            self.__init__()
+        for segment in displaySet:
+            if segment.type == WDS:
+                self.window = segment
+            elif segment.type == PDS:
+                self.palettes[segment.payload[0]] = segment
+            elif segment.type == ODS:
+                objectId = struct.unpack_from(">H", segment.payload)[0]
+                if segment.payload[3] & FIRST_IN_SEQUENCE:
+                    self.objects[objectId] = []
+                self.objects.setdefault(objectId, []).append(segment)
+
+
+def standalone(displaySet: list[Segment], state: EpochState) -> list:
+    # 'displaySet' as the start of a new epoch, with everything it uses from
+    # the display sets in front of it.
+    pcs = displaySet[0]
+    ownTypes = {segment.type for segment in displaySet}
+    ownPalettes = {s.payload[0] for s in displaySet if s.type == PDS}
+    ownObjects = {
+        struct.unpack_from(">H", s.payload)[0] for s in displaySet if s.type == ODS
+    }
+
+    payload = bytearray(pcs.payload)
+    payload[STATE_OFFSET] = EPOCH_START
+    payload[PALETTE_UPDATE_OFFSET] = 0
+    result: list = [HEADER.pack(MAGIC, pcs.pts, pcs.dts, PCS, len(payload)) + payload]
+    copies = []
+    if WDS not in ownTypes and state.window:
+        copies.append(state.window)
+    paletteId = payload[PALETTE_ID_OFFSET]
+    if paletteId not in ownPalettes and paletteId in state.palettes:
+        copies.append(state.palettes[paletteId])
+    for _, objectId, _ in compositionObjects(payload):
+        if objectId not in ownObjects:
+            copies += state.objects.get(objectId, [])
+    result += [segment.retimed(pcs.pts, pcs.dts) for segment in copies]
+    result += [segment.data for segment in displaySet[1:]]
+    # The segment type is the last byte before the size.
+    order = {PCS: 0, WDS: 1, PDS: 2, ODS: 3, END: 4}
+    return sorted(result, key=lambda data: order.get(data[HEADER.size - 3], 3))
+
+
+def selectCaptions(sets: list[list[Segment]], forced: bool) -> tuple[list, int]:
+    # Segment data of the captions that are (or aren't) forced, and how many
+    # there are. A caption is a display set that shows something, together
+    # with the display sets after it that don't (like the one clearing it).
+    output: list = []
+    count = 0
+    state = EpochState()
+    keep = False
+    previousKept = True
+    for displaySet in sets:
+        pcs = displaySet[0].payload
+        if displaySet[0].type != PCS:
+            raise ValueError("Display set without a PCS.")
+        if pcs[OBJECTS_OFFSET] > 0:
+            keep = isForced(pcs) == forced
+            count += keep
+        if keep:
+            if previousKept or pcs[STATE_OFFSET] & EPOCH_START:
+                output += [segment.data for segment in displaySet]
+            else:
+                output += standalone(displaySet, state)
+        previousKept = keep
+        state.update(displaySet)
+    return output, count
+
+
+def writeSegments(outFile, output: list):
+    with open(outFile, "wb") as f:
+        for data in output:
+            f.write(data)
+
+
+def splitForced(supFile, forcedFile, otherFile) -> int:
+    # Writes the forced captions of 'supFile' to 'forcedFile', and the other
+    # ones to 'otherFile'. Nothing is written when there are no forced
+    # captions. Returns the number of forced captions.
+    if Path(supFile).stat().st_size == 0:
+        return 0
+    with open(supFile, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _splitForced(memoryview(data), forcedFile, otherFile)
+
+
+def _splitForced(data: memoryview, forcedFile, otherFile) -> int:
+    # Separate from 'splitForced()', so every view of the map is gone when
+    # this returns and the map can be closed.
+    with data:
+        sets = displaySets(readSegments(data))
+        forced, count = selectCaptions(sets, True)
+        if count == 0:
+            return 0
+        writeSegments(forcedFile, forced)
+        del forced
+        other, _ = selectCaptions(sets, False)
+        writeSegments(otherFile, other)
+        del other, sets
+    return count
+
+
+def countCaptions(supFile) -> int:
+    # Display sets that show something.
+    if Path(supFile).stat().st_size == 0:
+        return 0
+    count = 0
+    with open(supFile, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = 0
+            while offset + HEADER.size <= len(data):
+                _, _, _, segmentType, size = HEADER.unpack_from(data, offset)
+                offset += HEADER.size
+                if segmentType == PCS and size > OBJECTS_OFFSET:
+                    count += data[offset + OBJECTS_OFFSET] > 0
+                offset += size
+    return count
+
+
+def writeShards(supFile, outFiles: list) -> list:
+    # Cuts 'supFile' into (up to) one part per file in 'outFiles', with about
+    # the same number of captions each. Parts start at the start of an epoch,
+    # so each one can be decoded on its own. Returns the files written.
+    if Path(supFile).stat().st_size == 0:
+        return []
+    with open(supFile, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _writeShards(memoryview(data), outFiles)
+
+
+def _writeShards(data: memoryview, outFiles: list) -> list:
+    with data:
+        sets = displaySets(readSegments(data))
+        # Captions in front of each display set.
+        before = []
+        count = 0
+        for displaySet in sets:
+            before.append(count)
+            count += displaySet[0].payload[OBJECTS_OFFSET] > 0
+        epochStarts = [
+            i
+            for i, displaySet in enumerate(sets)
+            if i > 0 and displaySet[0].payload[STATE_OFFSET] & EPOCH_START
+        ]
+
+        cuts = [0]
+        for part in range(1, len(outFiles)):
+            target = count * part / len(outFiles)
+            for i in epochStarts:
+                if i > cuts[-1] and before[i] >= target:
+                    cuts.append(i)
+                    break
+        cuts.append(len(sets))
+
+        written = []
+        for outFile, start, end in zip(outFiles, cuts, cuts[1:]):
+            writeSegments(
+                outFile, [s.data for displaySet in sets[start:end] for s in displaySet]
+            )
+            written.append(outFile)
+        del sets
+    return written
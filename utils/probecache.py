@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# 'ffprobe' results, kept in memory and on disk.
+#
+# Probing a remux with '-show_frames' takes a few seconds, and the same file
+# gets probed by the 'config' command, 'Info', and 'videoInfo'. A file is
+# only probed again when its path, size, or mtime changed.
+import copy
+import json
+import subprocess as sp
+import threading
+
+try:
+    import cache
+    from stages import popen
+except:
+    from utils import cache
+    from utils.stages import popen
+
+# Streams and container tags, 'videoInfo' probes the frames it needs by itself.
+PROBE_ARGS = ["-show_format", "-show_streams"]
+
+_results: dict[str, dict] = {}
+_resultsLock = threading.Lock()
+
+
+def probe(inFile: str, args: list[str] = PROBE_ARGS) -> dict:
+    key = cache.hashKey({"file": cache.fileFingerprint(inFile), "args": list(args)})
+
+    with _resultsLock:
+        result = _results.get(key)
+    if result is None:
+        result = cache.readCache("probe", key)
+    if result is None:
+        process = popen(
+            ["ffprobe", "-v", "quiet", "-print_format", "json"] + args + [inFile],
+            stdout=sp.PIPE,
+            encoding="utf-8",
+        )
+        output, _ = process.communicate()
+        if process.returncode != 0:
+            raise sp.CalledProcessError(process.returncode, process.args)
+        result = json.loads(output)
+        cache.writeCache("probe", key, result)
+
+    with _resultsLock:
+        _results[key] = result
+    # Callers are free to change what they get.
+    return copy.deepcopy(result)
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# Progress of the external tools, in one format.
+#
+# Every tool reports progress its own way (ffmpeg with '-progress', x265 on
+# stderr, mkvmerge/mkvextract with '--gui-mode'), the parsers below turn
+# that into events like:
+#   {"time": ..., "title": "bloopers", "stage": "audio:2", "tool": "ffmpeg",
+#    "status": "running", "fraction": 0.42, "fps": null, "bitrate": 640.0,
+#    "speed": 52.1, "eta": 31.5}
+# ('bitrate' in kbit/s, 'eta' in seconds). Events are appended as json lines
+# to a file, if one is set, and everything that is running is printed as
+# one line every 'VIEW_INTERVAL' seconds. Jobs running in other processes
+# write to the same file, and 'watchFile()' shows all of them in one view.
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+# Seconds between two lines of the terminal view.
+VIEW_INTERVAL = 5.0
+
+X265_PROGRESS = re.compile(
+    r"\[(?P<percent>[\d.]+)%\]\s+(?P<frame>\d+)/(?P<frames>\d+) frames,\s+"
+    r"(?P<fps>[\d.]+) fps,\s+(?P<bitrate>[\d.]+) kb/s"
+    r"(?:,\s+eta (?P<eta>\d+:\d+:\d+))?"
+)
+X265_PROGRESS_NO_TOTAL = re.compile(
+    r"^(?P<frame>\d+) frames:\s+(?P<fps>[\d.]+) fps,\s+(?P<bitrate>[\d.]+) kb/s"
+)
+MKVTOOLNIX_PROGRESS = re.compile(r"^#GUI#progress (?P<percent>\d+)%")
+
+
+class ProgressReporter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.title = ""
+        self.jsonFile: Path | None = None
+        self.view = True
+        self.running: dict[str, dict] = {}
+        self.started: dict[str, float] = {}
+        self.lastView = 0.0
+
+    def configure(self, title: str = "", jsonFile=None, view: bool = True):
+        with self.lock:
+            self.title = title
+            self.jsonFile = Path(jsonFile) if jsonFile else None
+            self.view = view
+
+    def report(
+        self,
+        stage: str,
+        tool: str,
+        status: str = "running",
+        fraction: float | None = None,
+        fps: float | None = None,
+        bitrate: float | None = None,
+        speed: float | None = None,
+        eta: float | None = None,
+    ):
+        with self.lock:
+            started = self.started.setdefault(stage, time.monotonic())
+            if eta is None and fraction and status == "running":
+                eta = (time.monotonic() - started) * (1 - fraction) / fraction
+            event = {
+                "time": round(time.time(), 3),
+                "title": self.title,
+                "stage": stage,
+                "tool": tool,
+                "status": status,
+                "fraction": None if fraction is None else round(fraction, 4),
+                "fps": fps,
+                "bitrate": bitrate,
+                "speed": speed,
+                "eta": None if eta is None else round(eta, 1),
+            }
+            if status == "running":
+                self.running[stage] = event
+            else:
+                self.running.pop(stage, None)
+                self.started.pop(stage, None)
+            self.write(event)
+
+            if not self.view:
+                return
+            if status != "running":
+                print("[{}] {} {}".format(stage, tool, status), flush=True)
+            elif time.monotonic() - self.lastView >= VIEW_INTERVAL:
+                self.lastView = time.monotonic()
+                print(formatView(self.running.values()), flush=True)
+
+    def record(self, stage: str, tool: str, status: str, **fields):
+        # Only goes to the json lines, not the view.
+        with self.lock:
+            event = {
+                "time": round(time.time(), 3),
+                "title": self.title,
+                "stage": stage,
+                "tool": tool,
+                "status": status,
+            }
+            event.update(fields)
+            self.write(event)
+
+    def write(self, event: dict):
+        if not self.jsonFile:
+            return
+        # One write per line, so lines from several processes don't mix.
+        fd = os.open(self.jsonFile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(event) + "\n").encode("utf-8"))
+        finally:
+            os.close(fd)
+
+
+_reporter = ProgressReporter()
+
+
+def configure(title: str = "", jsonFile=None, view: bool = True):
+    _reporter.configure(title, jsonFile, view)
+
+
+def report(stage: str, tool: str, **event):
+    _reporter.report(stage, tool, **event)
+
+
+def record(stage: str, tool: str, status: str, **fields):
+    _reporter.record(stage, tool, status, **fields)
+
+
+def start(stage: str, tool: str):
+    _reporter.report(stage, tool)
+
+
+def finish(stage: str, tool: str, returncode: int | None = 0):
+    # mkvtoolnix exits with 1 on warnings.
+    if returncode == 0 or (returncode == 1 and tool.startswith("mkv")):
+        _reporter.report(stage, tool, "done", fraction=1.0)
+    else:
+        _reporter.report(stage, tool, "failed")
+
+
+def formatDuration(seconds: float) -> str:
+    seconds = int(seconds)
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def formatEvent(event: dict) -> str:
+    parts = [event["stage"]]
+    if event.get("title"):
+        parts[0] = "{}/{}".format(event["title"], event["stage"])
+    if event.get("fraction") is not None:
+        parts.append("{:.1f}%".format(event["fraction"] * 100))
+    if event.get("fps") is not None:
+        parts.append("{:.1f}fps".format(event["fps"]))
+    if event.get("speed") is not None:
+        parts.append("{:.1f}x".format(event["speed"]))
+    if event.get("bitrate") is not None:
+        parts.append("{:.0f}kb/s".format(event["bitrate"]))
+    if event.get("eta") is not None:
+        parts.append("ETA " + formatDuration(event["eta"]))
+    return " ".join(parts)
+
+
+def formatView(events) -> str:
+    events = sorted(events, key=lambda e: (e.get("title", ""), e["stage"]))
+    if not events:
+        return "[progress] idle"
+    return "[progress] " + " | ".join(formatEvent(e) for e in events)
+
+
+def splitLines(stream):
+    # Progress lines are often ended with '\r' instead of '\n'.
+    pending = b""
+    while True:
+        data = stream.read1(65536) if hasattr(stream, "read1") else stream.read(65536)
+        if not data:
+            break
+        pending += data
+        lines = re.split(rb"[\r\n]", pending)
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode("utf-8", errors="replace")
+    if pending:
+        yield pending.decode("utf-8", errors="replace")
+
+
+def parseClock(value: str) -> float:
+    hours, minutes, seconds = value.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def parseX265(line: str) -> dict | None:
+    match = X265_PROGRESS.search(line)
+    if match:
+        event = {
+            "fraction": int(match["frame"]) / max(1, int(match["frames"])),
+            "fps": float(match["fps"]),
+            "bitrate": float(match["bitrate"]),
+        }
+        if match["eta"]:
+            event["eta"] = parseClock(match["eta"])
+        return event
+    match = X265_PROGRESS_NO_TOTAL.search(line.strip())
+    if match:
+        return {"fps": float(match["fps"]), "bitrate": float(match["bitrate"])}
+    return None
+
+
+def parseMkvToolNix(line: str) -> dict | None:
+    match = MKVTOOLNIX_PROGRESS.search(line)
+    if match:
+        return {"fraction": int(match["percent"]) / 100}
+    if line.startswith("#GUI#"):
+        # Other GUI messages, the readable version is printed as well.
+        return {}
+    return None
+
+
+def ffmpegParser(duration: float = 0, frames: int = 0):
+    # '-progress' writes blocks of 'key=value' lines, ending with 'progress=...'.
+    block: dict[str, str] = {}
+
+    def parse(line: str) -> dict | None:
+        if "=" not in line:
+            return None
+        key, value = line.strip().split("=", 1)
+        block[key] = value
+        if key != "progress":
+            return {}
+
+        event = {}
+        try:
+            if frames and "frame" in block:
+                event["fraction"] = min(1.0, int(block["frame"]) / frames)
+            elif duration and block.get("out_time_us", "N/A") != "N/A":
+                event["fraction"] = min(
+                    1.0, int(block["out_time_us"]) / 1000000 / duration
+                )
+            if float(block.get("fps", "0")) > 0:
+                event["fps"] = float(block["fps"])
+            if block.get("bitrate", "N/A").endswith("kbits/s"):
+                event["bitrate"] = float(block["bitrate"][: -len("kbits/s")])
+            if block.get("speed", "N/A").endswith("x"):
+                event["speed"] = float(block["speed"][:-1])
+        except ValueError:
+            pass
+        if event.get("speed") and "fraction" in event and duration:
+            event["eta"] = duration * (1 - event["fraction"]) / event["speed"]
+        block.clear()
+        return event
+
+    return parse
+
+
+def follow(stream, stage: str, tool: str, parse, echo: bool = True):
+    # Reports what 'parse' makes of each line, lines it doesn't know
+    # (warnings, errors) are printed as they are.
+    for line in splitLines(stream):
+        event = parse(line)
+        if event:
+            _reporter.report(stage, tool, **event)
+        elif event is None and echo and line.strip():
+            print("[{}] {}".format(stage, line), flush=True)
+
+
+def watch(stream, stage: str, tool: str, parse, echo: bool = True):
+    # 'follow()' in a thread, for when this thread is busy feeding the tool.
+    _reporter.report(stage, tool)
+    thread = threading.Thread(
+        target=follow, args=(stream, stage, tool, parse, echo), daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def run(
+    process, stream=None, stage: str = "", tool: str = "", parse=None, echo=True
+) -> int:
+    # Tools without machine readable progress ('stream' is None) only
+    # report when they start and finish.
+    stage = stage or tool
+    _reporter.report(stage, tool)
+    if stream is not None:
+        follow(stream, stage, tool, parse, echo)
+    process.wait()
+    finish(stage, tool, process.returncode)
+    return process.returncode
+
+
+def tail(stream, lines: int = 20):
+    # Keeps the last lines of a tool's log, to show when it fails.
+    kept: deque[str] = deque(maxlen=lines)
+    thread = threading.Thread(
+        target=lambda: kept.extend(splitLines(stream)), daemon=True
+    )
+    thread.start()
+    return thread, kept
+
+
+def watchFile(jsonFile, stop: threading.Event, interval: float = VIEW_INTERVAL):
+    # Aggregated view of every job writing to 'jsonFile'.
+    running: dict[tuple, dict] = {}
+    position = 0
+    while not stop.wait(interval):
+        try:
+            with open(jsonFile, "rb") as f:
+                f.seek(position)
+                data = f.read()
+        except OSError:
+            continue
+        # Only complete lines, the rest is read next time.
+        data = data[: data.rfind(b"\n") + 1]
+        position += len(data)
+        for line in data.splitlines():
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            key = (event.get("title", ""), event.get("stage", ""))
+            if event.get("status") == "running":
+                running[key] = event
+            else:
+                running.pop(key, None)
+        if running:
+            print(formatView(running.values()), flush=True)
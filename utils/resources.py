@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# What every child process cost: wall time, CPU time, peak memory, and
+# how much it read and wrote.
+#
+# Children started through 'stages.popen()' are 'TrackedPopen's, which reap
+# the process with 'os.wait4()' to get its resource usage. Right before that
+# the exited (but not yet reaped) process still has its '/proc/<pid>/io',
+# which has the bytes it read and wrote (Linux only).
+#
+# The peak memory isn't taken from 'ru_maxrss', a child started with vfork()
+# (like 'subprocess' does) gets the peak of this process in there. Instead
+# 'VmHWM' of every running child is read every 'PEAK_INTERVAL' seconds.
+# Children that exit before that only count their 'ru_maxrss' when it is more
+# than the peak of this process when they were started, else the peak is
+# unknown (None).
+#
+# Children started some other way aren't tracked, like the ffmpeg passes
+# of 'ffmpeg-normalize'. Only their CPU time is known, as the 'untracked'
+# entry of the summary.
+#
+# Samples are tagged with the stage that started the process (see
+# 'setStage()'), and 'writeSummary()' writes them, with totals per stage and
+# per tool, to a json file in the title's folder.
+import json
+import os
+import resource
+import subprocess as sp
+import threading
+import time
+from pathlib import Path
+
+RESOURCES_FILE = "resources.json"
+IO_FIELDS = {
+    "rchar": "readChars",
+    "wchar": "writtenChars",
+    "read_bytes": "readBytes",
+    "write_bytes": "writtenBytes",
+}
+
+_samples: list[dict] = []
+_samplesLock = threading.Lock()
+_local = threading.local()
+_selfUsage = resource.getrusage(resource.RUSAGE_SELF)
+_childrenUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+_selfStart = time.monotonic()
+# How often the peak memory of the running children is read.
+PEAK_INTERVAL = 0.5
+_running: set = set()
+_runningLock = threading.Lock()
+_peakThread: threading.Thread | None = None
+
+
+def setStage(stage: str):
+    # Threads don't inherit this, pools pass it on with
+    # 'ThreadPoolExecutor(initializer=setStage, initargs=(currentStage(),))'.
+    _local.stage = stage
+
+
+def currentStage() -> str:
+    return getattr(_local, "stage", "")
+
+
+def readIO(pid: int) -> dict | None:
+    try:
+        lines = Path("/proc/{}/io".format(pid)).read_text().splitlines()
+    except OSError:
+        return None
+    io = {}
+    for line in lines:
+        key, _, value = line.partition(":")
+        if key in IO_FIELDS:
+            io[IO_FIELDS[key]] = int(value)
+    return io
+
+
+def readPeakRss(pid: int) -> int:
+    # 'VmHWM' of a running process, 0 once it exited.
+    try:
+        lines = Path("/proc/{}/status".format(pid)).read_text().splitlines()
+    except OSError:
+        return 0
+    for line in lines:
+        if line.startswith("VmHWM:"):
+            return int(line.split()[1]) * 1024
+    return 0
+
+
+def watchPeaks():
+    while True:
+        time.sleep(PEAK_INTERVAL)
+        with _runningLock:
+            processes = list(_running)
+        for process in processes:
+            process.peakRss = max(process.peakRss, readPeakRss(process.pid))
+
+
+def startWatching(process: "TrackedPopen"):
+    global _peakThread
+    with _runningLock:
+        _running.add(process)
+        if _peakThread is None:
+            _peakThread = threading.Thread(target=watchPeaks, daemon=True)
+            _peakThread.start()
+
+
+def stopWatching(process: "TrackedPopen"):
+    with _runningLock:
+        _running.discard(process)
+
+
+def _afterFork():
+    # Threads don't survive a fork, the pool processes of '--jobs' need their own.
+    global _peakThread, _runningLock
+    _peakThread = None
+    _runningLock = threading.Lock()
+    _running.clear()
+
+
+os.register_at_fork(after_in_child=_afterFork)
+
+
+class TrackedPopen(sp.Popen):
+    def __init__(self, cmd, *args, **kwargs):
+        self.stage = currentStage()
+        self.started = time.monotonic()
+        self.io: dict | None = None
+        self.recorded = False
+        self.peakRss = 0
+        # What 'ru_maxrss' of the child can start at, see the top of this file.
+        self.parentPeakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        super().__init__(cmd, *args, **kwargs)
+        startWatching(self)
+
+    def _waitpid(self, pid, options):
+        if pid == self.pid and not self.recorded:
+            # Wait for it to exit without reaping it, so its io stats are still there.
+            exited = os.waitid(
+                os.P_PID, pid, os.WEXITED | os.WNOWAIT | (options & os.WNOHANG)
+            )
+            if exited is None:
+                return (0, 0)
+            self.io = readIO(pid)
+            stopWatching(self)
+
+        result, status, usage = os.wait4(pid, options)
+        if result == self.pid and not self.recorded:
+            self.recorded = True
+            record(self, status, usage, time.monotonic())
+        return (result, status)
+
+    def _try_wait(self, wait_flags):
+        try:
+            return self._waitpid(self.pid, wait_flags)
+        except ChildProcessError:
+            return (self.pid, 0)
+
+    def _internal_poll(self, *args, **kwargs):
+        kwargs["_waitpid"] = self._waitpid
+        return super()._internal_poll(*args, **kwargs)
+
+
+def record(process: TrackedPopen, status: int, usage, ended: float):
+    args = process.args if isinstance(process.args, list) else [str(process.args)]
+    wall = ended - process.started
+    cpu = usage.ru_utime + usage.ru_stime
+    sample = {
+        "tool": Path(str(args[0])).name,
+        "stage": process.stage,
+        "args": " ".join(str(a) for a in args),
+        "returncode": os.waitstatus_to_exitcode(status),
+        "wallSeconds": round(wall, 3),
+        "userSeconds": round(usage.ru_utime, 3),
+        "systemSeconds": round(usage.ru_stime, 3),
+        # Average number of busy cores, 1.0 is one core all the time.
+        "cpuLoad": round(cpu / wall, 2) if wall > 0 else 0.0,
+        "peakRssBytes": peakRss(process, usage),
+        # Blocks that had to come from or go to the disk, not the page cache.
+        "blockReads": usage.ru_inblock,
+        "blockWrites": usage.ru_oublock,
+    }
+    if process.io:
+        sample.update(process.io)
+    with _samplesLock:
+        _samples.append(sample)
+
+
+def peakRss(process: TrackedPopen, usage) -> int | None:
+    # ru_maxrss is in KiB on Linux.
+    maxRss = usage.ru_maxrss * 1024
+    if maxRss > process.parentPeakRss:
+        return max(process.peakRss, maxRss)
+    return process.peakRss or None
+
+
+def reset():
+    global _selfUsage, _childrenUsage, _selfStart
+    with _samplesLock:
+        _samples.clear()
+    _selfUsage = resource.getrusage(resource.RUSAGE_SELF)
+    _childrenUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    _selfStart = time.monotonic()
+
+
+def samples() -> list[dict]:
+    with _samplesLock:
+        return list(_samples)
+
+
+def totals(samples: list[dict], key: str) -> dict:
+    result: dict[str, dict] = {}
+    for sample in samples:
+        total = result.setdefault(
+            sample[key] or "-",
+            {
+                "processes": 0,
+                "wallSeconds": 0.0,
+                "cpuSeconds": 0.0,
+                "peakRssBytes": 0,
+                "readBytes": 0,
+                "writtenBytes": 0,
+            },
+        )
+        total["processes"] += 1
+        total["wallSeconds"] += sample["wallSeconds"]
+        total["cpuSeconds"] += sample["userSeconds"] + sample["systemSeconds"]
+        total["peakRssBytes"] = max(total["peakRssBytes"], sample["peakRssBytes"] or 0)
+        total["readBytes"] += sample.get("readBytes", 0)
+        total["writtenBytes"] += sample.get("writtenBytes", 0)
+    for total in result.values():
+        total["wallSeconds"] = round(total["wallSeconds"], 3)
+        total["cpuSeconds"] = round(total["cpuSeconds"], 3)
+    return result
+
+
+def untracked(children, samples: list[dict]) -> dict:
+    # CPU time of the children that weren't started through 'stages.popen()'.
+    user = children.ru_utime - _childrenUsage.ru_utime
+    system = children.ru_stime - _childrenUsage.ru_stime
+    for sample in samples:
+        user -= sample["userSeconds"]
+        system -= sample["systemSeconds"]
+    return {
+        "userSeconds": round(max(0.0, user), 3),
+        "systemSeconds": round(max(0.0, system), 3),
+    }
+
+
+def writeSummary(path: Path):
+    # The python process itself counts too, VapourSynth filters run in it.
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    current = samples()
+    summary = {
+        "self": {
+            "wallSeconds": round(time.monotonic() - _selfStart, 3),
+            "userSeconds": round(usage.ru_utime - _selfUsage.ru_utime, 3),
+            "systemSeconds": round(usage.ru_stime - _selfUsage.ru_stime, 3),
+            "peakRssBytes": usage.ru_maxrss * 1024,
+        },
+        "untracked": untracked(children, current),
+        "stages": totals(current, "stage"),
+        "tools": totals(current, "tool"),
+        "processes": current,
+    }
+    tempPath = Path(path).with_suffix(".tmp")
+    tempPath.write_text(json.dumps(summary, indent=2))
+    tempPath.replace(path)
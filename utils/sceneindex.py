@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# Keyframe and scene change index of a source file.
+#
+# Finding scene cuts means decoding the whole source, so it is done once
+# (on a downscaled copy of every frame) and the result is kept in a small
+# binary file in the cache directory. The index is rebuilt when the source
+# file changes (see 'cache.fileFingerprint()').
+#
+# File layout:
+#   MAGIC
+#   uint32 (little endian) length of the json header
+#   json header ('fingerprint', 'frameCount', 'keyframeCount')
+#   uint32 array of keyframe positions
+#   uint16 array of scene change scores, one per frame (score * 65535)
+import json
+import struct
+import subprocess as sp
+import sys
+from array import array
+from pathlib import Path
+
+try:
+    import cache
+    import progress
+    from stages import popen
+except:
+    from utils import cache, progress
+    from utils.stages import popen
+
+MAGIC = b"PMSIDX1\n"
+# Width the frames are scaled down to before comparing them.
+ANALYSIS_WIDTH = 480
+# 'lavfi.scene_score' above this is treated as a scene cut.
+SCENE_THRESHOLD = 0.3
+SCORE_SCALE = 65535
+
+
+class SceneIndex:
+    def __init__(
+        self,
+        frameCount: int,
+        keyframes: list[int],
+        sceneScores: list[float],
+        fingerprint: dict = {},
+    ):
+        self.frameCount: int = frameCount
+        self.keyframes: list[int] = list(keyframes)
+        self.sceneScores: list[float] = list(sceneScores)
+        self.fingerprint: dict = fingerprint
+
+    def sceneCuts(self, threshold: float = SCENE_THRESHOLD) -> list[int]:
+        return [i for i, s in enumerate(self.sceneScores) if i > 0 and s >= threshold]
+
+    def splitPoints(self, threshold: float = SCENE_THRESHOLD) -> list[int]:
+        # Frames where starting a new GOP costs (almost) nothing.
+        return sorted(set(self.keyframes) | set(self.sceneCuts(threshold)))
+
+    def keyframeAtOrBefore(self, frame: int) -> int:
+        result = 0
+        for keyframe in self.keyframes:
+            if keyframe > frame:
+                break
+            result = keyframe
+        return result
+
+    def save(self, path: Path):
+        header = json.dumps(
+            {
+                "fingerprint": self.fingerprint,
+                "frameCount": self.frameCount,
+                "keyframeCount": len(self.keyframes),
+            }
+        ).encode("utf-8")
+        keyframes = array("I", self.keyframes)
+        scores = array(
+            "H", [min(SCORE_SCALE, round(s * SCORE_SCALE)) for s in self.sceneScores]
+        )
+        if sys.byteorder != "little":
+            keyframes.byteswap()
+            scores.byteswap()
+
+        tempPath = path.with_suffix(".tmp")
+        with open(tempPath, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+            f.write(keyframes.tobytes())
+            f.write(scores.tobytes())
+        tempPath.replace(path)
+
+    @classmethod
+    def load(cls, path: Path):
+        data = path.read_bytes()
+        if not data.startswith(MAGIC):
+            raise ValueError("'{}' is not a scene index.".format(path))
+        offset = len(MAGIC)
+        (headerLength,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        header = json.loads(data[offset : offset + headerLength])
+        offset += headerLength
+
+        keyframes = array("I")
+        keyframes.frombytes(data[offset : offset + header["keyframeCount"] * 4])
+        offset += header["keyframeCount"] * 4
+        scores = array("H")
+        scores.frombytes(data[offset : offset + header["frameCount"] * 2])
+        if sys.byteorder != "little":
+            keyframes.byteswap()
+            scores.byteswap()
+
+        if len(keyframes) != header["keyframeCount"]:
+            raise ValueError("'{}' is truncated.".format(path))
+        if len(scores) != header["frameCount"]:
+            raise ValueError("'{}' is truncated.".format(path))
+
+        return cls(
+            header["frameCount"],
+            keyframes.tolist(),
+            [s / SCORE_SCALE for s in scores],
+            header["fingerprint"],
+        )
+
+
+def indexPath(sourceFile) -> Path:
+    sourcePath = str(Path(sourceFile).resolve())
+    return cache.cacheDir("sceneindex").joinpath(cache.hashKey(sourcePath) + ".idx")
+
+
+def getKeyframes(sourceFile: str) -> tuple[list[int], int]:
+    # Only reads the packet headers of the first video stream, nothing is decoded.
+    # Returns keyframe positions (in display order) and the number of frames.
+    process = popen(
+        [
+            "ffprobe",
+            "-v",
+            "quiet",
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "packet=pts,flags",
+            "-of",
+            "csv=print_section=0",
+            sourceFile,
+        ],
+        stdout=sp.PIPE,
+        encoding="utf-8",
+    )
+    output, _ = process.communicate()
+    if process.returncode != 0:
+        raise sp.CalledProcessError(process.returncode, process.args)
+
+    packets = []
+    for line in output.splitlines():
+        fields = line.strip().split(",")
+        if len(fields) < 2 or not fields[0].lstrip("-").isdigit():
+            continue
+        packets.append((int(fields[0]), "K" in fields[1]))
+
+    # Packets are in decode order, frames in the output are in display order.
+    packets.sort()
+    keyframes = [i for i in range(len(packets)) if packets[i][1]]
+    return keyframes, len(packets)
+
+
+def getSceneScores(sourceFile: str, frameCount: int = 0) -> list[float]:
+    # 'select' only computes 'scene' when it is used, 'gte(scene,0)' keeps
+    # every frame, and 'metadata' prints the score of each one.
+    vf = "scale={}:-2:flags=fast_bilinear,".format(ANALYSIS_WIDTH)
+    vf += "select='gte(scene,0)',metadata=print:key=lavfi.scene_score:file=-"
+    # Started through 'popen()' so a failed stage can stop it.
+    process = popen(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-nostats",
+            "-loglevel",
+            "error",
+            "-progress",
+            "pipe:2",
+            "-i",
+            sourceFile,
+            "-map",
+            "0:v:0",
+            "-an",
+            "-sn",
+            "-dn",
+            "-vf",
+            vf,
+            "-f",
+            "null",
+            "-",
+        ],
+        stdout=sp.PIPE,
+        stderr=sp.PIPE,
+        universal_newlines=True,
+    )
+    parse = progress.ffmpegParser(frames=frameCount)
+    watcher = progress.watch(process.stderr.buffer, "sceneIndex", "ffmpeg", parse)
+
+    scores = []
+    for line in process.stdout:
+        if line.startswith("lavfi.scene_score="):
+            scores.append(float(line.split("=", 1)[1]))
+    process.wait()
+    watcher.join()
+    progress.finish("sceneIndex", "ffmpeg", process.returncode)
+    if process.returncode != 0:
+        raise sp.CalledProcessError(process.returncode, process.args)
+    return scores
+
+
+def buildSceneIndex(sourceFile: str) -> SceneIndex:
+    fingerprint = cache.fileFingerprint(sourceFile)
+    print("Building scene index of '{}'".format(Path(sourceFile).name))
+    keyframes, frameCount = getKeyframes(sourceFile)
+    scores = getSceneScores(sourceFile, frameCount)
+
+    # Packet and decoded frame counts can disagree by a frame or two
+    # on damaged sources, the packet count wins.
+    scores = scores[:frameCount] + [0.0] * (frameCount - len(scores))
+    return SceneIndex(frameCount, keyframes, scores, fingerprint)
+
+
+def getSceneIndex(sourceFile: str) -> SceneIndex:
+    path = indexPath(sourceFile)
+    fingerprint = cache.fileFingerprint(sourceFile)
+    if path.exists():
+        try:
+            index = SceneIndex.load(path)
+            if index.fingerprint == fingerprint:
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+        print("Scene index of '{}' is outdated.".format(Path(sourceFile).name))
+
+    index = buildSceneIndex(sourceFile)
+    index.save(path)
+    return index
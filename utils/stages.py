@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# Small dependency graph runner used to run independent conversion stages
+# (audio, subtitles, video, ...) of a title at the same time.
+#
+# Child processes started through 'popen()' are tracked, so that a failed
+# stage or CTRL-C can stop every other stage that is still running, and what
+# they cost is recorded per stage (see 'resources.py').
+import subprocess as sp
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import progress
+except:
+    from utils import progress
+
+try:
+    import resources
+except:
+    from utils import resources
+
+_processes: set[sp.Popen] = set()
+_processesLock = threading.Lock()
+_stopping = threading.Event()
+
+
+class StageCancelled(Exception):
+    pass
+
+
+def popen(cmd, **kwargs) -> sp.Popen:
+    if _stopping.is_set():
+        raise StageCancelled("Not starting '{}', stages are stopping.".format(cmd[0]))
+
+    process = resources.TrackedPopen(cmd, **kwargs)
+    with _processesLock:
+        for p in [p for p in _processes if p.poll() is not None]:
+            _processes.discard(p)
+        _processes.add(process)
+    return process
+
+
+def terminateProcesses():
+    _stopping.set()
+    with _processesLock:
+        processes = list(_processes)
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+
+
+class Stage:
+    def __init__(self, name: str, func, deps: list[str] = []):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.duration: float | None = None
+
+
+class StageGraph:
+    def __init__(self):
+        self.stages: dict[str, Stage] = {}
+
+    def add(self, name: str, func, deps: list[str] = []):
+        if name in self.stages:
+            raise ValueError("Stage '{}' already exists.".format(name))
+        self.stages[name] = Stage(name, func, deps)
+
+    def checkGraph(self):
+        for stage in self.stages.values():
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise ValueError(
+                        "Stage '{}' depends on unknown stage '{}'.".format(
+                            stage.name, dep
+                        )
+                    )
+
+        # Kahn's algorithm, anything left over is part of a cycle.
+        remaining = {name: set(stage.deps) for name, stage in self.stages.items()}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(
+                    "Stages have a dependency cycle: {}".format(", ".join(remaining))
+                )
+            for name in ready:
+                remaining.pop(name)
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+    def run(self, maxWorkers: int | None = None):
+        self.checkGraph()
+        _stopping.clear()
+
+        done: set[str] = set()
+        pending = dict(self.stages)
+        running = {}
+        startTimes = {}
+        error: BaseException | None = None
+
+        def timedStage(stage: Stage):
+            startTimes[stage.name] = time.monotonic()
+            resources.setStage(stage.name)
+            stage.func()
+
+        if not maxWorkers:
+            maxWorkers = max(1, len(self.stages))
+
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            try:
+                while pending or running:
+                    if error is None:
+                        for name, stage in list(pending.items()):
+                            if set(stage.deps).issubset(done):
+                                print("Starting stage '{}'".format(name))
+                                running[executor.submit(timedStage, stage)] = stage
+                                pending.pop(name)
+                    else:
+                        pending = {}
+
+                    if not running:
+                        break
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        stage = running.pop(future)
+                        if stage.name in startTimes:
+                            stage.duration = time.monotonic() - startTimes[stage.name]
+                        exception = future.exception()
+                        # Wall time of every stage, see 'benchmarks/pipeline.py'.
+                        progress.record(
+                            stage.name,
+                            "stages",
+                            "failed" if exception is not None else "done",
+                            seconds=round(stage.duration or 0.0, 3),
+                        )
+                        if exception is not None:
+                            print(
+                                "Stage '{}' failed: {!r}".format(stage.name, exception)
+                            )
+                            if error is None:
+                                error = exception
+                                # No point in waiting hours for the other stages.
+                                terminateProcesses()
+                            continue
+                        print(
+                            "Finished stage '{}' in {:.1f}s".format(
+                                stage.name, stage.duration or 0.0
+                            )
+                        )
+                        done.add(stage.name)
+            except KeyboardInterrupt:
+                terminateProcesses()
+                raise
+
+        if error is not None:
+            raise error
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Getting frames from VapourSynth into an encoder's stdin.
+#
+# A 4K 10-bit frame is about 25MB, and a pipe only holds 64KB by default,
+# so VapourSynth and the encoder take turns waiting on each other. Making
+# the pipe bigger, leaving out the per frame Y4M headers ('raw' frames), and
+# writing the frame planes straight to the pipe's file descriptor (without
+# Python's buffered writer copying them first) keeps the pipe from being
+# what limits fast presets.
+import fcntl
+import os
+from pathlib import Path
+
+# What we ask for, Linux caps it at '/proc/sys/fs/pipe-max-size'.
+PIPE_SIZE = 64 * 1024 * 1024
+PIPE_MAX_SIZE_FILE = "/proc/sys/fs/pipe-max-size"
+# x265 '--input-csp' for (subsampling_w, subsampling_h).
+X265_CSPS = {(1, 1): "i420", (1, 0): "i422", (0, 0): "i444"}
+
+
+def setPipeSize(fd: int, size: int = PIPE_SIZE) -> int:
+    # Returns the size the pipe ended up with, 0 when it can't be changed
+    # (not Linux, or not a pipe).
+    if not hasattr(fcntl, "F_SETPIPE_SZ"):
+        return 0
+    try:
+        size = min(size, int(Path(PIPE_MAX_SIZE_FILE).read_text()))
+    except (OSError, ValueError):
+        pass
+    try:
+        return fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, size)
+    except OSError:
+        # Over the per user limit of pipe memory, keep what it has.
+        try:
+            return fcntl.fcntl(fd, fcntl.F_GETPIPE_SZ)
+        except OSError:
+            return 0
+
+
+def x265RawArgs(video) -> list[str] | None:
+    # x265 arguments that describe raw frames of 'video',
+    # None if x265 can't read its format as raw frames.
+    fmt = video.format
+    if fmt is None or video.fps.numerator == 0 or video.width == 0:
+        # Variable format, resolution, or frame rate.
+        return None
+    if fmt.sample_type != 0 or fmt.bytes_per_sample > 2:
+        # Float samples.
+        return None
+    if fmt.color_family.name == "GRAY":
+        csp = "i400"
+    elif fmt.color_family.name == "YUV":
+        csp = X265_CSPS.get((fmt.subsampling_w, fmt.subsampling_h))
+        if csp is None:
+            return None
+    else:
+        return None
+
+    return [
+        "--input-res",
+        "{}x{}".format(video.width, video.height),
+        "--fps",
+        "{}/{}".format(video.fps.numerator, video.fps.denominator),
+        "--input-depth",
+        str(fmt.bits_per_sample),
+        "--input-csp",
+        csp,
+    ]
+
+
+class PipeWriter:
+    # File object for 'VideoNode.output()' that hands every plane to
+    # 'os.write()' as is. A blocking pipe can still take less than all of
+    # it when a signal arrives, so the rest is written from a memoryview
+    # instead of a copy.
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    def write(self, data) -> int:
+        view = memoryview(data)
+        view = view.cast("B") if view.c_contiguous else memoryview(view.tobytes())
+        written = 0
+        while written < len(view):
+            written += os.write(self.fd, view[written:])
+        return written
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def flush(self):
+        pass
+
+
+def outputFrames(video, pipe, raw: bool = False, prefetch: int = 0):
+    # 'pipe' is the stdin of the encoder, started with 'bufsize=0'.
+    setPipeSize(pipe.fileno())
+    video.output(PipeWriter(pipe.fileno()), y4m=not raw, prefetch=prefetch)
@@ -5,11 +5,26 @@
 #
 # Mainly to help handle HDR content, but also to provide extra parameters that
 # are not compression related.
-import json
-import subprocess as sp
 import sys
 import shutil
 import math
+import os
+
+try:
+    import probecache
+    from stages import popen
+except:
+    from utils import probecache
+    from utils.stages import popen
+
+
+# Only the video streams are interesting here.
+STREAM_ARGS = ["-select_streams", "v", "-show_streams"]
+# Frames (per video stream) read when looking for HDR side data.
+# A keyframe carries all the side data of its stream, so the second probe
+# only happens when the first frame isn't a keyframe or has no side data.
+PROBE_FRAMES = [1, 20]
+HDR_TRANSFERS = ["smpte2084", "arib-std-b67"]
 
 
 class videoInfo:
@@ -44,31 +59,21 @@ class videoInfo:
     HDR10PlusTool = "hdr10plus_tool"
 
     ffprobeInfo = dict()
+    # Frame side data by stream index.
+    frameSideData = dict()
 
-    def __init__(self, in_file: str):
+    def __init__(self, in_file: str, ffprobeInfo: dict | None = None):
         self.inFile = in_file
         self.DVMetadataFile = in_file + "_dv.rpu"
         self.HDR10PlusMetadataFile = in_file + "_hdrplus.json"
-        self.ffprobeInfo = dict(
-            json.loads(
-                sp.check_output(
-                    (
-                        "ffprobe",
-                        "-v",
-                        "quiet",
-                        "-print_format",
-                        "json",
-                        "-show_format",
-                        "-show_streams",
-                        "-show_frames",
-                        "-read_intervals",
-                        "%+#20",
-                        in_file,
-                    ),
-                    encoding="utf-8",
-                )
-            )
-        )
+        # 'ffprobeInfo' can come from somewhere else (like 'matroska.probe()'),
+        # as long as it looks like ffprobe's output.
+        if ffprobeInfo is None:
+            ffprobeInfo = probecache.probe(in_file, STREAM_ARGS)
+        if "frames" not in ffprobeInfo:
+            ffprobeInfo["frames"] = self.__probeFrames(ffprobeInfo["streams"])
+        self.ffprobeInfo = ffprobeInfo
+        self.frameSideData = self.__indexFrameSideData()
 
         # Go through each video stream and check for HDR metadata.
         for stream in self.ffprobeInfo["streams"]:
@@ -121,113 +126,87 @@ class videoInfo:
                     self.HDR10 = True
 
     def extractDoviHEVC(self, outFile: str):
-        if not shutil.which(self.DoviTool):
-            return 1
-
-        # Convert RPU to profile 8.1 and drop Enhancement Layer.
-        doviCmd = [
-            "dovi_tool",
-            "-m",
-            "2",
-            "convert",
-            "--discard",
-            "--output",
-            outFile,
-            "-",
-        ]
-
-        ffmpegProcess = sp.Popen(
-            (
-                "ffmpeg",
-                "-loglevel",
-                "fatal",
-                "-stats",
-                "-i",
-                self.inFile,
-                "-map",
-                "0:0",
-                "-c:v",
-                "copy",
-                "-bsf:v",
-                "hevc_mp4toannexb",
-                "-f",
-                "hevc",
-                "-",
-            ),
-            stdout=sp.PIPE,
-        )
-        DoviProcess = sp.Popen(doviCmd, stdin=ffmpegProcess.stdout)
-        DoviProcess.communicate()
-        return 0
+        return self.extractMetadata(doviHEVCFile=outFile)
 
     def extractHDR10PlusMetadata(self):
-        if not shutil.which(self.HDR10PlusTool):
-            return 1
-
-        HDR10PlusCmd = [
-            "hdr10plus_tool",
-            "extract",
-            "--output",
-            self.HDR10PlusMetadataFile,
-            "-",
-        ]
-
-        ffmpegProcess = sp.Popen(
-            (
-                "ffmpeg",
-                "-loglevel",
-                "fatal",
-                "-stats",
-                "-i",
-                self.inFile,
-                "-map",
-                "0:0",
-                "-c:v",
-                "copy",
-                "-f",
-                "hevc",
-                "-",
-            ),
-            stdout=sp.PIPE,
-        )
-        HDR10PlusProcess = sp.Popen(HDR10PlusCmd, stdin=ffmpegProcess.stdout)
-        HDR10PlusProcess.communicate()
-        return 0
+        return self.extractMetadata(hdr10Plus=True)
 
     def extractDoviRPU(self):
-        if not shutil.which(self.DoviTool):
-            return 1
-
-        doviCmd = [
-            "dovi_tool",
-            "--mode",
-            "2",
-            "extract-rpu",
-            "--rpu-out",
-            self.DVMetadataFile,
-            "-",
-        ]
-
-        ffmpegProcess = sp.Popen(
-            (
-                "ffmpeg",
-                "-loglevel",
-                "fatal",
-                "-stats",
-                "-i",
-                self.inFile,
-                "-map",
-                "0:" + str(self.DVTrack),
-                "-c:v",
-                "copy",
-                "-f",
-                "hevc",
+        return self.extractMetadata(doviRPU=True)
+
+    def extractMetadata(
+        self, hdr10Plus: bool = False, doviRPU: bool = False, doviHEVCFile: str = ""
+    ):
+        # The video stream of a UHD remux is 60-80GB, so it's read only once.
+        # ffmpeg writes a copy of it to one pipe per tool ('pipe:<fd>'),
+        # and every tool reads its own pipe at the same time.
+        consumers = []
+        if hdr10Plus:
+            if not shutil.which(self.HDR10PlusTool):
+                return 1
+            HDR10PlusCmd = [
+                "hdr10plus_tool",
+                "extract",
+                "--output",
+                self.HDR10PlusMetadataFile,
                 "-",
-            ),
-            stdout=sp.PIPE,
-        )
-        doviProcess = sp.Popen(doviCmd, stdin=ffmpegProcess.stdout)
-        doviProcess.communicate()
+            ]
+            consumers.append(("0:0", [], HDR10PlusCmd))
+        if doviRPU or doviHEVCFile:
+            if not shutil.which(self.DoviTool):
+                return 1
+        if doviRPU:
+            doviCmd = [
+                "dovi_tool",
+                "--mode",
+                "2",
+                "extract-rpu",
+                "--rpu-out",
+                self.DVMetadataFile,
+                "-",
+            ]
+            consumers.append(("0:" + str(self.DVTrack), [], doviCmd))
+        if doviHEVCFile:
+            # Convert RPU to profile 8.1 and drop Enhancement Layer.
+            doviCmd = [
+                "dovi_tool",
+                "-m",
+                "2",
+                "convert",
+                "--discard",
+                "--output",
+                doviHEVCFile,
+                "-",
+            ]
+            consumers.append(("0:0", ["-bsf:v", "hevc_mp4toannexb"], doviCmd))
+        if not consumers:
+            return 0
+
+        ffmpegCmd = ["ffmpeg", "-loglevel", "fatal", "-stats", "-i", self.inFile]
+        pipes = []
+        for streamMap, outputOpts, cmd in consumers:
+            readFd, writeFd = os.pipe()
+            pipes.append((readFd, writeFd))
+            ffmpegCmd += ["-map", streamMap, "-c:v", "copy"] + outputOpts
+            ffmpegCmd += ["-f", "hevc", "pipe:{}".format(writeFd)]
+
+        ffmpegProcess = popen(ffmpegCmd, pass_fds=[w for _, w in pipes])
+        processes = []
+        for (readFd, writeFd), (_, _, cmd) in zip(pipes, consumers):
+            # Only ffmpeg may keep the write end open, or the tools never see EOF.
+            os.close(writeFd)
+            processes.append(popen(cmd, stdin=readFd))
+            os.close(readFd)
+
+        for process in processes:
+            process.wait()
+        ffmpegProcess.wait()
+
+        if ffmpegProcess.returncode != 0:
+            return ffmpegProcess.returncode
+        for process in processes:
+            if process.returncode != 0:
+                return process.returncode
         return 0
 
     def __getContentLightLeveData(self, sideDataList):
@@ -334,15 +313,64 @@ class videoInfo:
                 return True
         return False
 
-    def __getFrameSideDataList(self, stream):
+    def __probeFrames(self, streams: list) -> list:
+        # SDR video has nothing to find, so don't decode anything.
+        hdrStreams = []
+        for stream in streams:
+            if stream["codec_type"] != "video":
+                continue
+            doviConfig = False
+            for sideData in stream.get("side_data_list", []):
+                if "dovi" in sideData.get("side_data_type", "").lower():
+                    doviConfig = True
+            if stream.get("color_transfer") in HDR_TRANSFERS or doviConfig:
+                hdrStreams.append(stream["index"])
+        if not hdrStreams:
+            return []
+
+        frames = []
+        for frameCount in PROBE_FRAMES:
+            frames = probecache.probe(
+                self.inFile,
+                [
+                    "-select_streams",
+                    "v",
+                    "-show_entries",
+                    "frame=stream_index,key_frame:frame_side_data_list",
+                    "-read_intervals",
+                    "%+#{}".format(frameCount),
+                ],
+            ).get("frames", [])
+
+            # Side data missing from a keyframe isn't in the stream at all.
+            firstFrames = {}
+            for frame in frames:
+                firstFrames.setdefault(frame.get("stream_index"), frame)
+            if all(
+                index in firstFrames
+                and firstFrames[index].get("key_frame") == 1
+                and firstFrames[index].get("side_data_list")
+                for index in hdrStreams
+            ):
+                break
+        return frames
+
+    def __indexFrameSideData(self) -> dict:
+        # Side data of each video stream by 'stream_index', the first entry
+        # of each type wins.
+        index = {}
         for frame in self.ffprobeInfo["frames"]:
-            if "stream_index" not in frame:
+            if "stream_index" not in frame or "side_data_list" not in frame:
                 continue
-            if frame["stream_index"] == stream["index"]:
-                if "side_data_list" not in frame:
-                    return None
+            sideDataList = index.setdefault(frame["stream_index"], [])
+            types = [sideData["side_data_type"] for sideData in sideDataList]
+            for sideData in frame["side_data_list"]:
+                if sideData.get("side_data_type") not in types:
+                    sideDataList.append(sideData)
+        return index
 
-                return frame["side_data_list"]
+    def __getFrameSideDataList(self, stream):
+        return self.frameSideData.get(stream["index"])
 
 
 if __name__ == "__main__":